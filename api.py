@@ -0,0 +1,274 @@
+"""Versioned JSON API for Warbler clients.
+
+Routes live under /api/v1 and return compact JSON built from plain column
+tuples (no ORM objects are hydrated):
+
+- GET /api/v1/timeline: the logged-in user's home timeline
+- GET /api/v1/users/<id>/messages: a user's messages
+- GET /api/v1/messages/<id>: one message
+- POST /api/v1/follows: follow many users at once
+- DELETE /api/v1/follows: unfollow many users at once
+
+Lists are newest first, `?limit=` long (default 20, at most 100), with a
+`next_cursor` to pass back as `?before=` for the next page. Every response
+carries an ETag (see conditional.py) so unchanged pages revalidate as 304s.
+
+The follow routes take a JSON body, `{"user_ids": [...]}` (at most
+MAX_BULK_FOLLOWS ids), and answer with a result per id. Requiring a JSON
+body keeps them safe from cross-site form posts.
+
+If the `orjson` package is installed it's used for serialization; the
+output is the same either way.
+"""
+
+import json
+from datetime import datetime
+
+from flask import Blueprint, Response, abort, g, request
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import HTTPException
+
+try:
+    import orjson
+except ImportError:  # optional: the stdlib encoder is used without it
+    orjson = None
+
+import conditional
+import current_user
+import tasks
+import timeline
+from models import db, Follows, Message, User
+from pagination import before, decode_cursor, split_page
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+MAX_BULK_FOLLOWS = 500
+
+bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# the only columns a message payload is built from
+MESSAGE_COLUMNS = (
+    Message.id,
+    Message.text,
+    Message.timestamp,
+    Message.user_id,
+    Message.like_count,
+    User.username,
+    User.image_url,
+)
+
+
+def dumps(payload):
+    """`payload` as compact JSON bytes."""
+
+    if orjson is not None:
+        return orjson.dumps(payload)
+
+    return json.dumps(payload, separators=(',', ':'), ensure_ascii=False,
+                      default=datetime.isoformat).encode('utf-8')
+
+
+def json_response(payload, status=200):
+    return Response(dumps(payload), status=status, mimetype='application/json')
+
+
+def message_payload(row):
+    """JSON-ready dict for a row of MESSAGE_COLUMNS."""
+
+    return {
+        'id': row.id,
+        'text': row.text,
+        'timestamp': row.timestamp,
+        'likes': row.like_count,
+        'user': {
+            'id': row.user_id,
+            'username': row.username,
+            'image_url': row.image_url,
+        },
+    }
+
+
+def page_payload(rows, limit):
+    """`{"messages": [...], "next_cursor": ...}` for `limit + 1` rows."""
+
+    rows, next_cursor = split_page(rows, limit)
+    return {
+        'messages': [message_payload(row) for row in rows],
+        'next_cursor': next_cursor,
+    }
+
+
+def page_args():
+    """`(limit, cursor)` from the query string; 400 if either is bogus."""
+
+    limit = request.args.get('limit', DEFAULT_LIMIT, type=int)
+    if not 1 <= limit <= MAX_LIMIT:
+        abort(400, f"limit must be between 1 and {MAX_LIMIT}")
+
+    token = request.args.get('before')
+    try:
+        cursor = decode_cursor(token) if token else None
+    except ValueError:
+        abort(400, "Invalid cursor")
+
+    return limit, cursor
+
+
+def message_rows():
+    """Select of MESSAGE_COLUMNS, authors joined in."""
+
+    return (select(*MESSAGE_COLUMNS)
+            .join(User, User.id == Message.user_id)
+            .where(User.deleted_at.is_(None)))
+
+
+@bp.route('/timeline')
+def timeline_messages():
+    """The logged-in user's home timeline."""
+
+    if not g.user:
+        abort(401)
+
+    limit, cursor = page_args()
+    keys = timeline.home_timeline_keys(g.user.id, limit=limit + 1,
+                                       before=cursor)
+    ids = [message_id for _, message_id in keys]
+
+    def render():
+        rows = {row.id: row for row in db.session.execute(
+            message_rows().where(Message.id.in_(ids)))} if ids else {}
+        rows = [rows[message_id] for message_id in ids if message_id in rows]
+        return json_response(page_payload(rows, limit))
+
+    return conditional.respond(render, keys, limit, timeline.list_version(ids))
+
+
+@bp.route('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """`user_id`'s messages."""
+
+    updated_at = db.session.execute(
+        select(User.updated_at)
+        .where(User.id == user_id)
+        .where(User.deleted_at.is_(None))).first()
+    if updated_at is None:
+        abort(404)
+    updated_at = updated_at[0]
+
+    limit, cursor = page_args()
+
+    query = message_rows().where(Message.user_id == user_id)
+    if cursor:
+        query = query.where(before(Message.timestamp, Message.id, cursor))
+    rows = db.session.execute(
+        query
+        .order_by(Message.timestamp.desc(), Message.id.desc())
+        .limit(limit + 1)).all()
+
+    # like counts change without a timestamp, so there's no Last-Modified;
+    # a 304 still skips serializing the page
+    return conditional.respond(lambda: json_response(page_payload(rows, limit)),
+                               user_id, updated_at, limit,
+                               [(row.id, row.like_count) for row in rows])
+
+
+@bp.route('/messages/<int:message_id>')
+def message(message_id):
+    """One message."""
+
+    row = db.session.execute(
+        message_rows()
+        .add_columns(User.updated_at)
+        .where(Message.id == message_id)).first()
+    if row is None:
+        abort(404)
+
+    return conditional.respond(lambda: json_response(message_payload(row)),
+                               row.id, row.timestamp, row.updated_at,
+                               row.like_count)
+
+
+def user_ids_arg():
+    """The `user_ids` list from the JSON body; 400 if it's bogus."""
+
+    body = request.get_json(silent=True)
+    user_ids = body.get('user_ids') if isinstance(body, dict) else None
+    if (not isinstance(user_ids, list)
+            or not all(type(user_id) is int for user_id in user_ids)):
+        abort(400, "Expected a JSON body like {\"user_ids\": [1, 2, 3]}")
+    if len(user_ids) > MAX_BULK_FOLLOWS:
+        abort(400, f"At most {MAX_BULK_FOLLOWS} user_ids at a time")
+
+    return list(dict.fromkeys(user_ids))
+
+
+@bp.route('/follows', methods=['POST'])
+def follow_users():
+    """Follow every user in `user_ids`.
+
+    Each id's result is "followed", "already_following" or "not_found".
+    The new follows' messages are copied into the timeline in the
+    background, so they can take a moment to show up there.
+    """
+
+    if not g.user:
+        abort(401)
+
+    user_ids = user_ids_arg()
+    try:
+        followed, missing = Follows.follow_many(g.user.id, user_ids)
+        if followed:
+            tasks.enqueue(timeline.backfill_follows, g.user.id, followed)
+        db.session.commit()
+    except IntegrityError:
+        # a user was deleted between the lookup and the insert
+        db.session.rollback()
+        abort(409, "Some of those users just went away; try again")
+
+    current_user.forget(g.user.id, *followed)
+
+    followed, missing = set(followed), set(missing)
+    return json_response({'results': [
+        {'id': user_id,
+         'result': ('followed' if user_id in followed else
+                    'not_found' if user_id in missing else
+                    'already_following')}
+        for user_id in user_ids]})
+
+
+@bp.route('/follows', methods=['DELETE'])
+def unfollow_users():
+    """Unfollow every user in `user_ids`.
+
+    Each id's result is "unfollowed" or "not_following".
+    """
+
+    if not g.user:
+        abort(401)
+
+    user_ids = user_ids_arg()
+    unfollowed = Follows.unfollow_many(g.user.id, user_ids)
+    if unfollowed:
+        timeline.drop_follows(g.user.id, unfollowed)
+    db.session.commit()
+    current_user.forget(g.user.id, *unfollowed)
+
+    unfollowed = set(unfollowed)
+    return json_response({'results': [
+        {'id': user_id,
+         'result': 'unfollowed' if user_id in unfollowed else 'not_following'}
+        for user_id in user_ids]})
+
+
+@bp.errorhandler(HTTPException)
+def api_error(err):
+    """Errors as `{"error": ...}` instead of HTML pages."""
+
+    return json_response({'error': err.description}, err.code)
+
+
+def init_app(app):
+    """Mount the API on `app`."""
+
+    app.register_blueprint(bp)
@@ -1,13 +1,32 @@
+import json
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import Flask, render_template, request, flash, redirect, session, g, abort, jsonify
 # from flask_debugtoolbar import DebugToolbarExtension
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import IntegrityError, NoResultFound
+from sqlalchemy.orm import joinedload
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm, LikeForm
-from models import db, connect_db, User, Message, Likes
+from models import db, connect_db, Follows, User, Message, Likes
+import api
+import assets
+import conditional
+import current_user
+import fragments
+import instrumentation
+import migrations
+from passwords import PasswordPoolBusy
+import purge
+import replicas
+import search
+import tasks
+import timeline
+from pagination import (before, decode_cursor, decode_rank_cursor, split_page,
+                        split_ranked_page)
 
 CURR_USER_KEY = "curr_user"
+MESSAGES_PER_PAGE = 100
 
 app = Flask(__name__)
 
@@ -17,12 +36,54 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgresql://warbler'))
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    name: int(os.environ[key])
+    for name, key in [('pool_size', 'DATABASE_POOL_SIZE'),
+                      ('max_overflow', 'DATABASE_MAX_OVERFLOW')]
+    if key in os.environ}
+# comma-separated; GETs of read-only pages are served from these (see replicas.py)
+app.config['DATABASE_REPLICA_URLS'] = os.environ.get('DATABASE_REPLICA_URLS')
+app.config['REPLICA_POOL_SIZE'] = (
+    int(os.environ['REPLICA_POOL_SIZE']) if 'REPLICA_POOL_SIZE' in os.environ else None)
+app.config['REPLICA_MAX_OVERFLOW'] = (
+    int(os.environ['REPLICA_MAX_OVERFLOW']) if 'REPLICA_MAX_OVERFLOW' in os.environ else None)
+app.config['REPLICA_PIN_SECONDS'] = float(os.environ.get('REPLICA_PIN_SECONDS', 10))
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+# bcrypt runs on a bounded thread pool (see passwords.py)
+app.config['PASSWORD_POOL_WORKERS'] = int(os.environ.get('PASSWORD_POOL_WORKERS', 4))
+app.config['PASSWORD_QUEUE_DEPTH'] = int(os.environ.get('PASSWORD_QUEUE_DEPTH', 32))
+app.config['PASSWORD_TIMEOUT'] = float(os.environ.get('PASSWORD_TIMEOUT', 10))
+# set to e.g. sqlite:////tmp/warbler-users.db to share across workers
+app.config['USER_CACHE_URL'] = os.environ.get('USER_CACHE_URL')
+app.config['FRAGMENT_CACHE_URL'] = os.environ.get('FRAGMENT_CACHE_URL')
+# per-request SQL counts/timings in Server-Timing and the warbler.sql log
+app.config['SQL_INSTRUMENTATION'] = bool(os.environ.get('SQL_INSTRUMENTATION'))
+app.config['SQL_SLOW_REQUEST_MS'] = int(os.environ.get('SQL_SLOW_REQUEST_MS', 500))
+# the background job queue (see tasks.py)
+app.config['TASKS_EAGER'] = bool(os.environ.get('TASKS_EAGER'))
+app.config['TASK_MAX_ATTEMPTS'] = int(os.environ.get('TASK_MAX_ATTEMPTS', 5))
+app.config['TASK_BACKOFF_SECONDS'] = float(os.environ.get('TASK_BACKOFF_SECONDS', 10))
+app.config['TASK_LEASE_SECONDS'] = float(os.environ.get('TASK_LEASE_SECONDS', 600))
+app.config['TASK_POLL_SECONDS'] = float(os.environ.get('TASK_POLL_SECONDS', 1))
+app.config['TASK_LIMITS'] = {
+    kind: int(limit)
+    for kind, _, limit in (pair.partition('=')
+                           for pair in os.environ.get('TASK_LIMITS', '').split(',')
+                           if pair)}
+# accounts with more rows than this are purged in the background (see purge.py)
+app.config['PURGE_CHUNK_SIZE'] = int(os.environ.get('PURGE_CHUNK_SIZE', 500))
 # toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+replicas.init_app(app)
+current_user.init_app(app)
+fragments.init_app(app)
+api.init_app(app)
+instrumentation.init_app(app)
+assets.init_app(app)
 
 
 ##############################################################################
@@ -31,10 +92,14 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    g.user is a cached snapshot (see current_user.py); routes that change
+    the user work on `g.user.record`.
+    """
+
+    if CURR_USER_KEY in session and request.endpoint != 'static':
+        g.user = current_user.load(session[CURR_USER_KEY])
 
     else:
         g.user = None
@@ -46,6 +111,35 @@ def do_login(user):
     session[CURR_USER_KEY] = user.id
 
 
+def get_page_cursor(decode=decode_cursor):
+    """Decode the `?before=` pagination cursor, if any; 400 if it's bogus."""
+
+    token = request.args.get('before')
+    if not token:
+        return None
+
+    try:
+        return decode(token)
+    except ValueError:
+        abort(400)
+
+
+def wants_json():
+    """Did a script (rather than a plain form post) make this request?"""
+
+    return (request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+            or request.accept_mimetypes.best == 'application/json')
+
+
+def followed_ids(users):
+    """Ids among `users` that the logged-in user follows, as a set."""
+
+    if not g.user:
+        return set()
+
+    return g.user.following_ids_among(user.id for user in users)
+
+
 def do_logout():
     """Logout user."""
 
@@ -98,6 +192,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # authenticate may have upgraded the stored hash
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -123,34 +219,67 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by username, bio and
+    location; results are ranked and paged with 'page'.
     """
 
-    search = request.args.get('q')
+    search_q = request.args.get('q')
+    page = request.args.get('page', 1, type=int)
+    has_more = False
 
-    if not search:
-        users = User.query.all()
+    if not search_q:
+        users = User.visible().all()
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users, has_more = search.search_users(search_q, page)
+
+    return render_template('users/index.html', users=users,
+                           following_ids=followed_ids(users),
+                           q=search_q, page=page, has_more=has_more)
+
 
-    return render_template('users/index.html', users=users)
+@app.route('/users/autocomplete')
+def autocomplete_users():
+    """JSON list of users whose username starts with 'q', for typeahead."""
+
+    users = search.autocomplete_users(request.args.get('q'))
+    return jsonify([{"id": user.id,
+                     "username": user.username,
+                     "image_url": user.image_url}
+                    for user in users])
 
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile.
 
-    user = User.query.get_or_404(user_id)
+    Messages are paged newest first; `?before=<cursor>` fetches older ones.
+    """
 
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    user = User.visible().filter_by(id=user_id).first_or_404()
+    cursor = get_page_cursor()
+    following_ids = followed_ids([user])
+
+    def render():
+        query = Message.query.filter(Message.user_id == user_id)
+        if cursor:
+            query = query.filter(before(Message.timestamp, Message.id, cursor))
+
+        # snagging messages in order from the database;
+        # user.messages won't be in order by default
+        messages = (query
+                    .order_by(Message.timestamp.desc(), Message.id.desc())
+                    .limit(MESSAGES_PER_PAGE + 1)
+                    .all())
+        messages, next_cursor = split_page(messages, MESSAGES_PER_PAGE)
+        return render_template('users/show.html', user=user, messages=messages,
+                               next_cursor=next_cursor,
+                               following_ids=following_ids)
+
+    # posting or deleting a message bumps the user's messages_count, and
+    # with it updated_at, so the row version covers the message list too
+    return conditional.respond(render, user.id, user.updated_at,
+                               sorted(following_ids),
+                               last_modified=user.updated_at)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -161,8 +290,10 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = User.visible().filter_by(id=user_id).first_or_404()
+    following = [followed for followed in user.following if followed.deleted_at is None]
+    return render_template('users/following.html', user=user, following=following,
+                           following_ids=followed_ids(following + [user]))
 
 @app.route('/users/<int:user_id>/likes')
 def show_liked_messages(user_id):
@@ -171,8 +302,18 @@ def show_liked_messages(user_id):
             flash("Access unauthorized.", "danger")
             return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('/users/likes.html', user=user)
+    user = User.visible().filter_by(id=user_id).first_or_404()
+    messages = (Message
+                .query
+                .options(joinedload(Message.user))
+                .join(Likes, Likes.message_id == Message.id)
+                .filter(Likes.user_id == user_id)
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .limit(MESSAGES_PER_PAGE)
+                .all())
+    messages = [msg for msg in messages if msg.user.deleted_at is None]
+    return render_template('/users/likes.html', user=user, messages=messages,
+                           following_ids=followed_ids([user]))
 
 
 
@@ -184,8 +325,10 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = User.visible().filter_by(id=user_id).first_or_404()
+    followers = [follower for follower in user.followers if follower.deleted_at is None]
+    return render_template('users/followers.html', user=user, followers=followers,
+                           following_ids=followed_ids(followers + [user]))
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -196,9 +339,15 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    try:
+        if Follows.follow(g.user.id, follow_id):
+            timeline.backfill_follow(g.user.id, follow_id)
+        db.session.commit()
+    except (IntegrityError, NoResultFound):
+        db.session.rollback()
+        abort(404)
+
+    current_user.forget(g.user.id, follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -211,9 +360,10 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    if Follows.unfollow(g.user.id, follow_id):
+        timeline.drop_follow(g.user.id, follow_id)
     db.session.commit()
+    current_user.forget(g.user.id, follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -238,6 +388,7 @@ def edit_profile():
             user.bio = form.bio.data
             db.session.add(user)
             db.session.commit()
+            current_user.forget(user.id)
             flash("User Updated!", "success")
             return redirect(f"/users/{user.id}")
         else:
@@ -257,8 +408,10 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
-    db.session.commit()
+    # a single DELETE (the database cascades it), or hidden now and
+    # purged in the background for big accounts
+    purge.delete_user(g.user.id)
+    current_user.forget(g.user.id)
 
     return redirect("/signup")
 
@@ -281,21 +434,59 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        User.adjust_counts(g.user.id, messages_count=1)
+        timeline.fan_out_message(msg)
         db.session.commit()
+        current_user.forget(g.user.id)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+def messages_search():
+    """Search messages by text.
+
+    Takes 'q'; 'following=1' limits results to the logged-in user and the
+    people they follow. Results are ranked and paged with `?before=`.
+    """
+
+    q = request.args.get('q', '')
+    following_only = bool(request.args.get('following')) and g.user is not None
+
+    results = search.search_messages(
+        q,
+        viewer_id=g.user.id if following_only else None,
+        before=get_page_cursor(decode_rank_cursor))
+    results, next_cursor = split_ranked_page(results, search.MESSAGES_PER_PAGE)
+
+    return render_template('messages/search.html', q=q,
+                           following_only=following_only,
+                           messages=[msg for _, msg in results],
+                           next_cursor=next_cursor)
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = Message.query.options(joinedload(Message.user)).get_or_404(message_id)
+    if msg.user.deleted_at is not None:
+        abort(404)
+    following_ids = followed_ids([msg.user])
+
+    def render():
+        return render_template('messages/show.html', message=msg,
+                               following_ids=following_ids)
+
+    changed = max(filter(None, [msg.timestamp, msg.user.updated_at]))
+    return conditional.respond(render, msg.id, msg.timestamp,
+                               msg.user.updated_at, sorted(following_ids),
+                               last_modified=changed)
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -306,28 +497,43 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
-    db.session.delete(msg)
+    msg = Message.query.get_or_404(message_id)
+    User.discount_message(msg)
+    # its likes and timeline entries go with it (ON DELETE CASCADE)
+    db.session.execute(db.delete(Message).where(Message.id == msg.id))
     db.session.commit()
+    current_user.forget(msg.user_id)
 
     return redirect(f"/users/{g.user.id}")
 
-@app.route('/users/add_like/<int:message_id>', methods=["GET", "POST"])
+@app.route('/users/add_like/<int:message_id>', methods=["POST"])
 def messages_user_favorite(message_id):
-    """User like a message"""
-    if not g.user:
+    """Like or unlike a message.
+
+    Scripted requests (see static/scripts/likes.js) get the new state and
+    the message's live like count back as `{"liked": ..., "likes": ...}`;
+    plain form posts are redirected home.
+    """
+
+    form = LikeForm()
+    if not g.user or not form.validate_on_submit():
+        if wants_json():
+            return jsonify(error="Access unauthorized."), 403
         flash("Access unauthorized.", "danger")
         return redirect("/")
-    user = g.user.id
-    message_id = message_id
-    like = Likes.query.filter_by(user_id=user, message_id=message_id).first()
-    if like:
-        #to unlike something
-        db.session.delete(like)
-    else:
-        new_like = Likes(user_id=g.user.id, message_id=message_id)
-        db.session.add(new_like)
-    db.session.commit()
+
+    try:
+        liked = Likes.toggle(g.user.id, message_id)
+        db.session.commit()
+    except (IntegrityError, NoResultFound):
+        db.session.rollback()
+        abort(404)
+
+    current_user.forget(g.user.id)
+
+    if wants_json():
+        return jsonify(liked=liked,
+                       likes=Likes.counts_for([message_id]).get(message_id, 0))
     return redirect('/')
 
 ##############################################################################
@@ -339,28 +545,116 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, read from
+      the user's materialized timeline; `?before=<cursor>` pages back
     """
 
     if g.user:
-        #ids of followed_users and current user's id
-        form = LikeForm()
-        followed_user_ids = [user.id for user in g.user.following] + [g.user.id]
-        messages = (Message
-                    .query
-                    #filter messages of followed users
-                    .filter(Message.user_id.in_(followed_user_ids))
-                    ##then ordered by timestamp
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        user_likes = [message.id for message in g.user.likes]
-        return render_template('home.html',form=form, messages=messages, user_likes=user_likes)
+        # pre-sorted slice of the materialized timeline (see timeline.py)
+        keys = timeline.home_timeline_keys(g.user.id,
+                                           limit=MESSAGES_PER_PAGE + 1,
+                                           before=get_page_cursor())
+        ids = [message_id for _, message_id in keys]
+        user_likes = g.user.liked_ids_among(ids)
+
+        def render():
+            form = LikeForm()
+            messages = timeline.load_messages(ids)
+            messages, next_cursor = split_page(messages, MESSAGES_PER_PAGE)
+            return render_template('home.html',form=form, messages=messages, user_likes=user_likes,
+                                   next_cursor=next_cursor)
+
+        # the page only changes when its messages, their like counts and
+        # authors' profiles or the viewer's likes do (or its like forms'
+        # CSRF tokens age)
+        return conditional.respond(render, keys, sorted(user_likes),
+                                   timeline.list_version(ids),
+                                   conditional.csrf_epoch())
 
     else:
         return render_template('home-anon.html')
 
 
+@app.errorhandler(PasswordPoolBusy)
+def password_pool_busy(err):
+    """Shed load fast when too many logins/signups are hashing at once."""
+
+    return ("Too many sign-ins in progress. Please try again in a moment.",
+            503, {"Retry-After": "1"})
+
+
+##############################################################################
+# Maintenance commands
+
+
+@tasks.job(limit=1)
+def reconcile_counts():
+    """Repair drift in the denormalized user and message counters."""
+
+    return User.reconcile_counts(), Message.reconcile_like_counts()
+
+
+@app.cli.command('reconcile-counts')
+def reconcile_counts_command():
+    """Repair drift in the denormalized user and message counters."""
+
+    users, messages = reconcile_counts()
+    db.session.commit()
+    print(f"Repaired counters for {users} user(s) and {messages} message(s).")
+
+
+@app.cli.command('worker')
+@click.option('--burst', is_flag=True, help="Exit once no jobs are due.")
+@click.option('--kind', 'kinds', multiple=True, help="Only run jobs of this kind.")
+def worker_command(burst, kinds):
+    """Run background jobs (see tasks.py)."""
+
+    tasks.work(burst=burst, kinds=list(kinds))
+
+
+@app.cli.command('enqueue')
+@click.argument('kind')
+@click.argument('args', nargs=-1)
+def enqueue_command(kind, args):
+    """Queue a background job, e.g. `flask enqueue reconcile_counts`.
+
+    ARGS are JSON values, e.g. `flask enqueue purge_user 42`.
+    """
+
+    if kind not in tasks.JOBS:
+        raise click.BadParameter(f"one of {', '.join(sorted(tasks.JOBS))}",
+                                 param_hint='KIND')
+
+    tasks.enqueue(tasks.JOBS[kind][0], *(json.loads(arg) for arg in args))
+    db.session.commit()
+    print(f"Queued {kind}.")
+
+
+@app.cli.command('purge-deleted-users')
+def purge_deleted_users_command():
+    """Finish purging accounts that were hidden for background deletion."""
+
+    print(f"Purged {purge.purge_deleted_users()} deleted user(s).")
+
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Bring an existing database's schema up to date."""
+
+    for version, description in migrations.upgrade():
+        print(f"Applied {version}: {description}")
+    print("Schema is up to date.")
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Fingerprint and precompress static files into static/dist."""
+
+    manifest = assets.build(app.static_folder, assets.assets_dir(app))
+    assets.load_manifest(app)
+    print(f"Built {len(manifest)} asset(s) into {assets.assets_dir(app)}.")
+
+
 ##############################################################################
 # Turn off all caching in Flask
 #   (useful for dev; in production, this kind of stuff is typically
@@ -369,11 +663,13 @@ def homepage():
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
 @app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+def add_header(resp):
+    """Don't let pages be stored unless their route set a cache policy.
+
+    Pages with validators (see conditional.py) set their own; static files
+    keep Flask's.
+    """
+
+    if request.endpoint != 'static':
+        resp.headers.setdefault('Cache-Control', 'no-store')
+    return resp
@@ -0,0 +1,175 @@
+"""Fingerprinted, precompressed static assets.
+
+`flask build-assets` copies everything under static/ into static/dist/
+with a content hash in each filename (style.css -> style.3f2a1b9c0d.css),
+rewrites url(/static/...) references inside stylesheets to match, writes
+gzip (and, if the `brotli` package is installed, brotli) variants of text
+files, and records the mapping in static/dist/manifest.json.
+
+Templates link assets with `asset_url('stylesheets/style.css')`. Hashed
+files are served from /assets/ with a year-long immutable Cache-Control,
+as the precompressed variant the client accepts when there is one. Until
+assets are built, `asset_url` falls back to the plain /static/ URL.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+
+from flask import abort, current_app, request, send_from_directory, url_for
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # optional: only gzip variants are written without it
+    brotli = None
+
+MANIFEST = 'manifest.json'
+
+# characters of the content hash kept in filenames
+HASH_LENGTH = 10
+
+# only text compresses usefully; images are already compressed
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.json', '.txt', '.map'}
+
+# preferred first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+_STATIC_URL = re.compile(r'''url\((['"]?)/static/([^'")?#]+)\1\)''')
+
+
+def _hashed_name(path, content):
+    digest = hashlib.sha256(content).hexdigest()[:HASH_LENGTH]
+    root, ext = os.path.splitext(path)
+    return f"{root}.{digest}{ext}"
+
+
+def _compress(dist_dir, name, content):
+    """Write .gz/.br next to `name` when they're actually smaller."""
+
+    variants = [('.gz', gzip.compress(content, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(content)))
+
+    for suffix, compressed in variants:
+        if len(compressed) < len(content):
+            with open(os.path.join(dist_dir, name + suffix), 'wb') as f:
+                f.write(compressed)
+
+
+def build(static_dir, dist_dir):
+    """Fingerprint and precompress `static_dir` into `dist_dir`.
+
+    Returns the manifest: source path (relative to `static_dir`) -> hashed
+    path (relative to `dist_dir`).
+    """
+
+    if os.path.exists(dist_dir):
+        shutil.rmtree(dist_dir)
+
+    sources = []
+    for root, dirs, files in os.walk(static_dir):
+        # don't fingerprint a previous build
+        dirs[:] = [d for d in dirs if os.path.abspath(os.path.join(root, d))
+                   != os.path.abspath(dist_dir)]
+        for filename in files:
+            path = os.path.join(root, filename)
+            sources.append(os.path.relpath(path, static_dir).replace(os.sep, '/'))
+
+    # stylesheets last, so the files they point at already have hashed names
+    sources.sort(key=lambda path: (path.endswith('.css'), path))
+
+    manifest = {}
+    for path in sources:
+        with open(os.path.join(static_dir, path), 'rb') as f:
+            content = f.read()
+
+        if path.endswith('.css'):
+            content = _STATIC_URL.sub(
+                lambda m: (f"url({m.group(1)}/assets/{manifest[m.group(2)]}{m.group(1)})"
+                           if m.group(2) in manifest else m.group(0)),
+                content.decode('utf-8')).encode('utf-8')
+
+        name = _hashed_name(path, content)
+        os.makedirs(os.path.dirname(os.path.join(dist_dir, name)), exist_ok=True)
+        with open(os.path.join(dist_dir, name), 'wb') as f:
+            f.write(content)
+
+        if os.path.splitext(path)[1] in COMPRESSIBLE:
+            _compress(dist_dir, name, content)
+
+        manifest[path] = name
+
+    with open(os.path.join(dist_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def assets_dir(app):
+    """Where `app`'s built assets and manifest live."""
+
+    return app.config.get('ASSETS_DIR') or os.path.join(app.static_folder, 'dist')
+
+
+def load_manifest(app):
+    """(Re)read the manifest for `app`; empty if assets aren't built."""
+
+    try:
+        with open(os.path.join(assets_dir(app), MANIFEST)) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        manifest = {}
+
+    app.extensions['assets'] = manifest
+    return manifest
+
+
+def asset_url(path):
+    """URL for static file `path`: fingerprinted if built, plain otherwise."""
+
+    hashed = current_app.extensions['assets'].get(path)
+    if hashed is None:
+        return url_for('static', filename=path)
+    return url_for('asset', filename=hashed)
+
+
+def serve_asset(filename):
+    """Serve a fingerprinted file, precompressed if the client allows."""
+
+    directory = assets_dir(current_app)
+    if filename == MANIFEST:
+        abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    encoding = None
+    for name, suffix in ENCODINGS:
+        variant = safe_join(directory, filename + suffix)
+        if (request.accept_encodings[name] > 0
+                and variant and os.path.isfile(variant)):
+            encoding, filename = name, filename + suffix
+            break
+
+    # send_file hands the open file to the server's wsgi.file_wrapper, which
+    # gunicorn turns into sendfile()
+    resp = send_from_directory(directory, filename, mimetype=mimetype,
+                               max_age=31536000)
+    if encoding:
+        resp.headers['Content-Encoding'] = encoding
+    resp.headers['Cache-Control'] = IMMUTABLE
+    resp.vary.add('Accept-Encoding')
+    return resp
+
+
+def init_app(app):
+    """Register the /assets/ route and the `asset_url` template helper."""
+
+    load_manifest(app)
+    app.add_url_rule('/assets/<path:filename>', 'asset', serve_asset)
+    app.add_template_global(asset_url)
@@ -0,0 +1,291 @@
+"""Per-route latency benchmarks for Warbler.
+
+Seeds datasets of a few sizes (generated by generator/create_csvs.py and
+loaded through seed.py), then requests each route in-process with the Flask
+test client as a logged-in user. For every route it records p50/p95/p99
+latency, SQL statements per request, peak Python memory per request and
+response size, and writes them all to a JSON file. The /api/v1 routes are
+measured like the pages, so their figures include JSON serialization.
+
+This drops and reloads the benchmark database, so point it at a scratch
+database (default postgresql:///warbler-bench; override with
+BENCHMARK_DATABASE_URL).
+
+Run like:
+
+    python benchmark.py run [--sizes small medium] [--output benchmark.json]
+    python benchmark.py compare baseline.json benchmark.json [--threshold 0.2]
+
+`compare` prints both runs side by side and exits non-zero if any route got
+slower (p95) or used more memory by more than the threshold, or issued more
+SQL statements.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from models import db, Message, User
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# --scale passed to the generator for each dataset
+SIZES = {
+    'small': 1,
+    'medium': 10,
+    'large': 100,
+}
+
+# route name -> URL; filled in with the ids picked by pick_targets()
+ROUTES = {
+    'home': '/',
+    'users': '/users',
+    'users_show': '/users/{profile_id}',
+    'followers': '/users/{profile_id}/followers',
+    'messages_show': '/messages/{message_id}',
+    'api_timeline': '/api/v1/timeline?limit=100',
+    'api_user_msgs': '/api/v1/users/{profile_id}/messages?limit=100',
+    'api_message': '/api/v1/messages/{message_id}',
+}
+
+ITERATIONS = 50
+WARMUP = 5
+
+# memory is measured on a few requests only: tracemalloc slows them down
+MEMORY_SAMPLES = 3
+
+
+def generate_data(size, data_dir):
+    """Generate CSVs for `size` into `data_dir` unless they exist already."""
+
+    out_dir = os.path.join(data_dir, size)
+    if not os.path.exists(os.path.join(out_dir, 'users.csv')):
+        subprocess.run([sys.executable,
+                        os.path.join(HERE, 'generator', 'create_csvs.py'),
+                        '--scale', str(SIZES[size]),
+                        '--out-dir', out_dir],
+                       check=True)
+    return out_dir
+
+
+def pick_targets():
+    """Ids of the users and message that make each route do the most work.
+
+    The viewer follows the most users (the biggest home timeline); the
+    profile has the most followers.
+    """
+
+    viewer = User.query.order_by(User.following_count.desc(), User.id).first()
+    profile = User.query.order_by(User.followers_count.desc(), User.id).first()
+    message = (Message.query
+               .filter(Message.user_id == profile.id)
+               .order_by(Message.timestamp.desc())
+               .first()) or Message.query.first()
+
+    return {
+        'viewer_id': viewer.id,
+        'profile_id': profile.id,
+        'message_id': message.id,
+    }
+
+
+class StatementCounter:
+    """Counts SQL statements sent on `engine`."""
+
+    def __init__(self, engine):
+        self.count = 0
+        db.event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args, **kwargs):
+        self.count += 1
+
+
+def percentile(samples, pct):
+    """`pct`th percentile of `samples`, interpolated between points."""
+
+    return statistics.quantiles(samples, n=100, method='inclusive')[pct - 1]
+
+
+def measure(client, url, counter, iterations=ITERATIONS, warmup=WARMUP):
+    """Latency, SQL statements, peak memory and body size for GET `url`."""
+
+    for _ in range(warmup):
+        client.get(url)
+
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        resp = client.get(url)
+        timings.append((time.perf_counter() - started) * 1000)
+
+    counter.count = 0
+    client.get(url)
+    statements = counter.count
+
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(MEMORY_SAMPLES):
+            tracemalloc.reset_peak()
+            client.get(url)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'status': resp.status_code,
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p95_ms': round(percentile(timings, 95), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+        'mean_ms': round(statistics.fmean(timings), 3),
+        'statements': statements,
+        'peak_kib': round(max(peaks) / 1024, 1),
+        'bytes': len(resp.data),
+    }
+
+
+def run_size(size, data_dir, counter, iterations):
+    """Seed the `size` dataset and benchmark every route against it."""
+
+    from app import app, CURR_USER_KEY
+    from seed import seed
+
+    with app.app_context():
+        seed(generate_data(size, data_dir))
+        targets = pick_targets()
+
+    results = {}
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = targets['viewer_id']
+
+        for name, url in ROUTES.items():
+            url = url.format(**targets)
+            results[name] = measure(client, url, counter, iterations)
+            print(f"{size:>6} {name:<14} p50 {results[name]['p50_ms']:>8.2f}ms "
+                  f"p95 {results[name]['p95_ms']:>8.2f}ms "
+                  f"sql {results[name]['statements']:>3} "
+                  f"mem {results[name]['peak_kib']:>8.1f}KiB")
+
+    return {'targets': targets, 'routes': results}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=HERE, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes, output, data_dir, iterations=ITERATIONS):
+    """Benchmark every route at each of `sizes` and write JSON to `output`."""
+
+    # as in the tests: pick the database before the app is imported (which
+    # connects to it)
+    os.environ['DATABASE_URL'] = os.environ.get('BENCHMARK_DATABASE_URL',
+                                                'postgresql:///warbler-bench')
+    from app import app
+
+    app.config['DEBUG_TB_ENABLED'] = False
+    with app.app_context():
+        counter = StatementCounter(db.engine)
+
+    report = {
+        'meta': {
+            'created': datetime.now(timezone.utc).isoformat(),
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0],
+            'iterations': iterations,
+        },
+        'sizes': {size: run_size(size, data_dir, counter, iterations)
+                  for size in sizes},
+    }
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {output}")
+    return report
+
+
+def compare(baseline, current, threshold=0.2):
+    """Print `current` against `baseline`; return a list of regressions.
+
+    A route regresses if its p95 latency or peak memory grew by more than
+    `threshold` (a fraction), or it issues more SQL statements.
+    """
+
+    regressions = []
+
+    for size, result in current['sizes'].items():
+        base_routes = baseline['sizes'].get(size, {}).get('routes', {})
+
+        for name, now in result['routes'].items():
+            before = base_routes.get(name)
+            if before is None:
+                print(f"{size:>6} {name:<14} (new)")
+                continue
+
+            problems = []
+            if now['p95_ms'] > before['p95_ms'] * (1 + threshold):
+                problems.append('p95')
+            if now['peak_kib'] > before['peak_kib'] * (1 + threshold):
+                problems.append('memory')
+            if now['statements'] > before['statements']:
+                problems.append('statements')
+
+            print(f"{size:>6} {name:<14} "
+                  f"p95 {before['p95_ms']:>8.2f} -> {now['p95_ms']:>8.2f}ms  "
+                  f"sql {before['statements']:>3} -> {now['statements']:>3}  "
+                  f"mem {before['peak_kib']:>8.1f} -> {now['peak_kib']:>8.1f}KiB"
+                  + (f"  REGRESSED ({', '.join(problems)})" if problems else ''))
+
+            regressions.extend((size, name, problem) for problem in problems)
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="seed and benchmark")
+    run_parser.add_argument('--sizes', nargs='+', choices=SIZES,
+                            default=list(SIZES))
+    run_parser.add_argument('--iterations', type=int, default=ITERATIONS)
+    run_parser.add_argument('--output', default='benchmark.json')
+    run_parser.add_argument('--data-dir',
+                            default=os.path.join(HERE, '.benchmark'),
+                            help="where generated CSVs are kept between runs")
+
+    compare_parser = commands.add_parser('compare',
+                                         help="flag regressions between runs")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.2,
+                                help="allowed fractional slowdown (default 0.2)")
+
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run(args.sizes, args.output, args.data_dir, args.iterations)
+
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+
+        regressions = compare(baseline, current, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s)")
+            sys.exit(1)
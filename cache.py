@@ -0,0 +1,131 @@
+"""Small key/value caches with LRU eviction and a TTL.
+
+Two backends share one interface (`get`, `set`, `delete`, `clear`):
+
+- `LRUCache`: in-process, per worker.
+- `SQLiteCache`: a local SQLite file, so every gunicorn worker on a host
+  sees the same entries and invalidations.
+
+Values must be JSON-serializable so both backends behave the same.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread-safe in-process cache: LRU eviction past `maxsize`, TTL expiry."""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+
+            self._data.move_to_end(key)
+            return json.loads(value)
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, json.dumps(value))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SQLiteCache:
+    """Cache in a local SQLite file shared by every worker on the host."""
+
+    def __init__(self, path, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._conn = sqlite3.connect(path, timeout=5, isolation_level=None,
+                                     check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires REAL NOT NULL,
+                    used REAL NOT NULL
+                )""")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS cache_used ON cache (used)")
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires FROM cache WHERE key = ?",
+                (str(key),)).fetchone()
+            if row is None:
+                return None
+
+            value, expires = row
+            if expires < now:
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (str(key),))
+                return None
+
+            self._conn.execute("UPDATE cache SET used = ? WHERE key = ?",
+                               (now, str(key)))
+            return json.loads(value)
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires, used) "
+                "VALUES (?, ?, ?, ?)",
+                (str(key), json.dumps(value), now + self.ttl, now))
+            self._conn.execute(
+                "DELETE FROM cache WHERE key IN ("
+                "  SELECT key FROM cache ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (self.maxsize,))
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (str(key),))
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM cache")
+
+
+def make_cache(url=None, maxsize=1024, ttl=60):
+    """Build a cache from a URL.
+
+    None or 'memory://' gives a per-worker LRUCache; 'sqlite:///path/to/file'
+    gives a SQLiteCache shared by every process that opens that file.
+    """
+
+    if not url or url == 'memory://':
+        return LRUCache(maxsize=maxsize, ttl=ttl)
+
+    if url.startswith('sqlite:///'):
+        return SQLiteCache(url[len('sqlite:///'):], maxsize=maxsize, ttl=ttl)
+
+    raise ValueError(f"Unsupported cache URL: {url!r}")
@@ -0,0 +1,76 @@
+"""Conditional GET for rendered pages.
+
+Routes describe what their page shows as a few cheap values (row versions,
+ids of the messages listed, ...) and hand over a render function:
+
+    return conditional.respond(render, user.id, user.updated_at)
+
+The values are hashed into an ETag together with the logged-in user's
+snapshot, which every page shows in the navbar. When the client's
+If-None-Match (or, for anonymous pages, If-Modified-Since) still matches,
+a 304 goes back without rendering the template.
+
+Pages carrying one-off flash messages are never validated or cached.
+"""
+
+import hashlib
+import json
+import time
+
+from flask import current_app, g, make_response, request, session
+from werkzeug.http import is_resource_modified
+
+from current_user import SNAPSHOT_FIELDS
+
+# pages that rely on validators instead of being re-sent in full
+LOGGED_IN_POLICY = 'private, no-cache'
+ANONYMOUS_POLICY = 'public, no-cache'
+
+
+def make_etag(*parts):
+    """ETag over `parts` and the logged-in user's snapshot."""
+
+    viewer = [getattr(g.user, name) for name in SNAPSHOT_FIELDS] if g.user else None
+    payload = json.dumps([viewer, parts], default=str, separators=(',', ':'))
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def csrf_epoch():
+    """Changes halfway through each CSRF token lifetime.
+
+    Pages with CSRF-protected forms include it in their validators so a
+    revalidated page never carries a token that's about to expire.
+    """
+
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    return int(time.time() // (limit / 2)) if limit else None
+
+
+def respond(render, *parts, last_modified=None):
+    """Render the page, or answer 304 if the client's copy is current.
+
+    `last_modified` is only used for anonymous requests: logged-in pages
+    also depend on the viewer's follows and likes, which have no timestamp.
+    """
+
+    if session.get('_flashes'):
+        resp = make_response(render())
+        resp.headers['Cache-Control'] = 'no-store'
+        return resp
+
+    etag = make_etag(*parts)
+    if g.user:
+        last_modified = None
+
+    if is_resource_modified(request.environ, etag=etag,
+                            last_modified=last_modified):
+        resp = make_response(render())
+    else:
+        resp = make_response('', 304)
+
+    resp.set_etag(etag)
+    if last_modified is not None:
+        resp.last_modified = last_modified
+    resp.headers['Cache-Control'] = LOGGED_IN_POLICY if g.user else ANONYMOUS_POLICY
+    resp.vary.add('Cookie')
+    return resp
@@ -0,0 +1,111 @@
+"""Cached resolution of the logged-in user.
+
+`add_user_to_g` runs on every request, so instead of loading the full User
+row each time it reads a small snapshot (id, username, images, counters)
+from a cache. The ORM object is only loaded when a route asks for
+`g.user.record` (or touches an attribute the snapshot doesn't carry),
+which is what routes that mutate the user do.
+
+Configure with:
+
+- USER_CACHE_URL: None/'memory://' for a per-worker cache, or
+  'sqlite:////path/to/file' for one shared by every worker on the host
+- USER_CACHE_TTL: seconds a snapshot may be served (default 60)
+- USER_CACHE_SIZE: max snapshots kept (default 10000)
+
+Routes that change a snapshot field call `forget()` after committing.
+Counters of users who are only touched indirectly (e.g. likers of a deleted
+message) are refreshed when their snapshot's TTL runs out.
+"""
+
+from flask import current_app
+
+from cache import make_cache
+from models import db, User
+
+SNAPSHOT_FIELDS = (
+    'id',
+    'username',
+    'image_url',
+    'header_image_url',
+    'messages_count',
+    'following_count',
+    'followers_count',
+    'likes_count',
+)
+
+
+class UserSnapshot:
+    """Lightweight, cacheable stand-in for the logged-in User."""
+
+    # these only need `self.id`, so they work on a snapshot as-is
+    is_following = User.is_following
+    is_followed_by = User.is_followed_by
+    following_ids_among = User.following_ids_among
+    liked_ids_among = User.liked_ids_among
+
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+        self._record = None
+
+    def __repr__(self):
+        return f"<UserSnapshot #{self.id}: {self.username}>"
+
+    @property
+    def record(self):
+        """The full User row, loaded on first use."""
+
+        if self._record is None:
+            self._record = db.session.get(User, self.id)
+        return self._record
+
+    def __getattr__(self, name):
+        # anything not in the snapshot (relationships, email, ...) comes
+        # from the real row
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.record, name)
+
+
+def init_app(app):
+    """Attach the current-user cache to `app`."""
+
+    cache = make_cache(app.config.get('USER_CACHE_URL'),
+                       maxsize=app.config.get('USER_CACHE_SIZE', 10000),
+                       ttl=app.config.get('USER_CACHE_TTL', 60))
+    app.extensions['user_cache'] = cache
+
+    # a freshly created users table hands out ids again from 1
+    db.event.listen(User.__table__, 'after_create',
+                    lambda *args, **kwargs: cache.clear())
+
+
+def _cache():
+    return current_app.extensions['user_cache']
+
+
+def load(user_id):
+    """Snapshot of user `user_id`, from cache if possible; None if gone."""
+
+    fields = _cache().get(user_id)
+
+    if fields is None:
+        columns = [getattr(User, name) for name in SNAPSHOT_FIELDS]
+        row = (db.session.query(*columns)
+               .filter(User.id == user_id)
+               .filter(User.deleted_at.is_(None))
+               .first())
+        if row is None:
+            return None
+
+        fields = row._asdict()
+        _cache().set(user_id, fields)
+
+    return UserSnapshot(fields)
+
+
+def forget(*user_ids):
+    """Drop cached snapshots after their user rows change."""
+
+    for user_id in user_ids:
+        _cache().delete(user_id)
@@ -0,0 +1,69 @@
+"""Cached rendering of message list items.
+
+A message's `<li>` body only changes when its author changes their
+username or picture (messages themselves are never edited), so templates
+render it once and reuse the HTML:
+
+    {% call cached_fragment(message_fragment_key('home', msg, msg.user)) %}
+      ...
+    {% endcall %}
+
+Anything that depends on the viewer (like the like button) stays outside
+the `call` block.
+
+Configure with:
+
+- FRAGMENT_CACHE_URL: None/'memory://' for a per-worker cache, or
+  'sqlite:////path/to/file' for one shared by every worker on the host
+- FRAGMENT_CACHE_TTL: seconds a fragment may be served (default 3600)
+- FRAGMENT_CACHE_SIZE: max fragments kept (default 10000)
+"""
+
+import hashlib
+
+from flask import current_app
+from markupsafe import Markup
+
+from cache import make_cache
+from models import db, Message
+
+
+def message_fragment_key(namespace, message, author):
+    """Cache key for `message` as rendered by template `namespace`.
+
+    Includes a digest of the author fields the fragment shows, so a profile
+    edit moves every one of their messages to a new key.
+    """
+
+    version = hashlib.sha1(
+        f"{author.username}\0{author.image_url}".encode('utf-8')).hexdigest()[:12]
+    return f"{namespace}:{message.id}:{version}"
+
+
+def cached_fragment(key, caller):
+    """Body of a `{% call %}` block, from the cache when possible."""
+
+    cache = current_app.extensions['fragment_cache']
+
+    html = cache.get(key)
+    if html is None:
+        html = str(caller())
+        cache.set(key, html)
+
+    return Markup(html)
+
+
+def init_app(app):
+    """Attach the fragment cache and its template helpers to `app`."""
+
+    cache = make_cache(app.config.get('FRAGMENT_CACHE_URL'),
+                       maxsize=app.config.get('FRAGMENT_CACHE_SIZE', 10000),
+                       ttl=app.config.get('FRAGMENT_CACHE_TTL', 3600))
+    app.extensions['fragment_cache'] = cache
+
+    # a freshly created messages table hands out ids again from 1
+    db.event.listen(Message.__table__, 'after_create',
+                    lambda *args, **kwargs: cache.clear())
+
+    app.add_template_global(cached_fragment)
+    app.add_template_global(message_fragment_key)
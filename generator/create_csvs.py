@@ -3,28 +3,79 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+Generation is offline and deterministic: the same --seed and --scale always
+produce the same files, however many processes do the work. Rows are
+produced in fixed-size chunks across a process pool and streamed to disk, so
+memory use doesn't grow with the dataset.
+
+The data is shaped like a real social network:
+
+- followers follow a power law: a few users have most of them
+- a few users write most of the messages
+- likes follow a power law too: most users like a few messages, and a few
+  popular messages collect most of the likes
+- messages arrive in bursts rather than evenly spread over time
+
+--scale 1 gives 300 users and 1,000 messages, like the committed CSVs;
+--scale 10000 gives 3M users and 10M messages.
+
+Run like:
+
+    python generator/create_csvs.py [--scale 1] [--seed 0] [--processes N]
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import io
+import os
+import random
+from array import array
+from datetime import datetime, timedelta
+from functools import lru_cache
+from itertools import accumulate
+from math import ceil, gcd
+from multiprocessing import Pool
+
 from faker import Faker
 from helpers import get_random_datetime
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['id', 'email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
-MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
+MESSAGES_CSV_HEADERS = ['id', 'text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
 
+# rows per unit of --scale
 NUM_USERS = 300
 NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+NUM_FOLLOWERS = 5000
+NUM_LIKES = 2000
+
+# Zipf exponents: how strongly followers / activity pile onto a few users,
+# and likes onto a few messages
+FOLLOWER_SKEW = 0.8
+ACTIVITY_SKEW = 0.9
+POPULARITY_SKEW = 1.0
 
-fake = Faker()
+# Pareto shapes for how many users each user follows / messages each likes
+FOLLOWING_SHAPE = 1.5
+LIKING_SHAPE = 1.5
 
-# Generate random profile image URLs to use for users
+# messages cluster in bursts of about this many, this many minutes apart
+MESSAGES_PER_BURST = 20
+BURST_GAP_MINUTES = 30
+
+# rows (followers, for follows.csv) generated per task
+CHUNK_SIZE = 20000
+
+# fixed "now" so timestamps don't depend on when the generator ran
+DEFAULT_NOW = datetime(2024, 1, 1)
+
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+# Random profile image URLs to use for users (linked, never downloaded here)
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +83,193 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+# Header images shipped with the app
 
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+    "/static/images/warbler-hero.jpg",
+    "/static/images/signed-out-home.jpg",
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+
+@lru_cache(maxsize=None)
+def _cum_weights(n, skew):
+    """Cumulative Zipf weights for ranks 1..n, for random.choices()."""
+
+    return array('d', accumulate(rank ** -skew for rank in range(1, n + 1)))
+
+
+def _shuffle(n, step, offset):
+    """`(step, offset)` such that `(rank * step + offset) % n` visits every
+    id once: a cheap fixed permutation that needs no n-sized table."""
+
+    step = step % n or 1
+    while gcd(step, n) != 1:
+        step += 1
+    return step, offset % n
+
+
+def _user_id(rank, plan, shuffle):
+    """Map a popularity rank to a user id, so popular users aren't all id 1."""
+
+    step, offset = plan[shuffle]
+    return (rank * step + offset) % plan['users'] + 1
+
+
+def _sample_users(rng, plan, skew, shuffle, k):
+    """`k` user ids drawn from a Zipf distribution over every user."""
+
+    ranks = rng.choices(range(plan['users']),
+                        cum_weights=_cum_weights(plan['users'], skew), k=k)
+    return [_user_id(rank, plan, shuffle) for rank in ranks]
+
+
+def _sample_messages(rng, plan, k):
+    """`k` message ids drawn from a Zipf distribution of popularity."""
+
+    ranks = rng.choices(range(plan['messages']),
+                        cum_weights=_cum_weights(plan['messages'], POPULARITY_SKEW),
+                        k=k)
+    step, offset = plan['message_order']
+    return [(rank * step + offset) % plan['messages'] + 1 for rank in ranks]
+
+
+def _users(rng, fake, plan, start, stop, writer):
+    for user_id in range(start + 1, stop + 1):
+        # suffixing the id keeps usernames and emails unique at any scale
+        writer.writerow([
+            user_id,
+            f"{fake.user_name()}{user_id}@{fake.free_email_domain()}",
+            f"{fake.user_name()}{user_id}",
+            rng.choice(image_urls),
+            PASSWORD,
+            fake.sentence(),
+            rng.choice(header_image_urls),
+            fake.city(),
+        ])
+
+
+def _messages(rng, fake, plan, start, stop, writer):
+    count = stop - start
+    bursts = [get_random_datetime(rng=rng, now=plan['now'])
+              for _ in range(ceil(count / MESSAGES_PER_BURST))]
+    authors = _sample_users(rng, plan, ACTIVITY_SKEW, 'activity_order', count)
+
+    for message_id, author in zip(range(start + 1, stop + 1), authors):
+        delay = timedelta(minutes=rng.expovariate(1 / BURST_GAP_MINUTES))
+        timestamp = min(rng.choice(bursts) + delay, plan['now'])
+        writer.writerow([
+            message_id,
+            fake.paragraph()[:MAX_WARBLER_LENGTH],
+            timestamp,
+            author,
+        ])
+
+
+def _follows(rng, fake, plan, start, stop, writer):
+    # Pareto(shape) has mean shape / (shape - 1); rescale to the target mean
+    scale = plan['following_mean'] * (FOLLOWING_SHAPE - 1) / FOLLOWING_SHAPE
+
+    for follower in range(start + 1, stop + 1):
+        count = min(round(rng.paretovariate(FOLLOWING_SHAPE) * scale),
+                    plan['users'] - 1)
+        followed = set(_sample_users(rng, plan, FOLLOWER_SKEW,
+                                     'follower_order', count))
+        followed.discard(follower)
+
+        for user_id in sorted(followed):
+            writer.writerow([user_id, follower])
+
+
+def _likes(rng, fake, plan, start, stop, writer):
+    scale = plan['likes_mean'] * (LIKING_SHAPE - 1) / LIKING_SHAPE
+
+    # one chunk per range of likers, so (user_id, message_id) stays unique
+    for user_id in range(start + 1, stop + 1):
+        count = min(round(rng.paretovariate(LIKING_SHAPE) * scale),
+                    plan['messages'])
+        for message_id in sorted(set(_sample_messages(rng, plan, count))):
+            writer.writerow([user_id, message_id])
+
+
+CSV_FILES = [
+    ('users.csv', USERS_CSV_HEADERS, _users, 'users'),
+    ('messages.csv', MESSAGES_CSV_HEADERS, _messages, 'messages'),
+    ('follows.csv', FOLLOWS_CSV_HEADERS, _follows, 'users'),
+    ('likes.csv', LIKES_CSV_HEADERS, _likes, 'users'),
+]
+
+
+def _generate_chunk(task):
+    """Rows `start`..`stop` of one CSV, as CSV text."""
+
+    index, start, stop, plan = task
+    _, _, write_rows, _ = CSV_FILES[index]
+
+    # seeded per chunk, so output doesn't depend on which process runs it
+    chunk_seed = f"{plan['seed']}:{index}:{start}"
+    rng = random.Random(chunk_seed)
+    fake = Faker()
+    fake.seed_instance(chunk_seed)
+
+    out = io.StringIO()
+    write_rows(rng, fake, plan, start, stop, csv.writer(out))
+    return out.getvalue()
+
+
+def make_plan(scale=1, seed=0, now=DEFAULT_NOW):
+    """Row counts and sampling parameters for a dataset of size `scale`."""
+
+    users = max(round(NUM_USERS * scale), 2)
+    messages = max(round(NUM_MESSAGES * scale), 1)
+
+    return {
+        'seed': seed,
+        'now': now,
+        'users': users,
+        'messages': messages,
+        'following_mean': NUM_FOLLOWERS / NUM_USERS,
+        'likes_mean': NUM_LIKES / NUM_USERS,
+        # different orders, so the most followed users aren't also the
+        # most active ones (that would make timelines quadratic)
+        'follower_order': _shuffle(users, 7919, 0),
+        'activity_order': _shuffle(users, 104729, users // 2),
+        'message_order': _shuffle(messages, 7919, 0),
+    }
+
+
+def generate(out_dir, scale=1, seed=0, processes=None, now=DEFAULT_NOW):
+    """Write users, messages, follows and likes CSVs into `out_dir`."""
+
+    plan = make_plan(scale, seed, now)
+    os.makedirs(out_dir, exist_ok=True)
+
+    with Pool(processes) as pool:
+        for index, (filename, headers, _, rows) in enumerate(CSV_FILES):
+            total = plan[rows]
+            tasks = [(index, start, min(start + CHUNK_SIZE, total), plan)
+                     for start in range(0, total, CHUNK_SIZE)]
+
+            written = 0
+            with open(os.path.join(out_dir, filename), 'w', newline='') as f:
+                csv.writer(f).writerow(headers)
+                # imap keeps chunks in order while later ones are generated
+                for text in pool.imap(_generate_chunk, tasks):
+                    f.write(text)
+                    written += text.count('\n')
+
+            print(f"{filename}: {written:,} rows")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', type=float, default=1,
+                        help="dataset size; 1 = 300 users, 1,000 messages")
+    parser.add_argument('--seed', default='0',
+                        help="random seed; same seed, same files")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument('--out-dir', default=os.path.dirname(os.path.abspath(__file__)),
+                        help="where to write the CSVs (default: next to this script)")
+    args = parser.parse_args()
+
+    generate(args.out_dir, args.scale, args.seed, args.processes)
@@ -1,14 +1,17 @@
 """Support functions for CSV generation."""
 
+import random
 from datetime import datetime
-from random import uniform
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def get_random_datetime(year_gap=2, rng=random, now=None):
+    """Get a random datetime within the last few years.
 
-    now = datetime.now()
+    Pass a seeded `rng` and a fixed `now` for reproducible output.
+    """
+
+    now = now or datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    random_timestamp = rng.uniform(then.timestamp(), now.timestamp())
 
     return datetime.fromtimestamp(random_timestamp)
@@ -0,0 +1,139 @@
+"""Per-request SQL instrumentation.
+
+SQLALCHEMY_ECHO logs every statement, which is far too much under real
+traffic. With SQL_INSTRUMENTATION on, each request instead gets:
+
+- a `Server-Timing` header with its DB time, statement count and total time
+- one structured (JSON) log line on the `warbler.sql` logger
+- a warning naming the statement whenever one shape of statement runs
+  SQL_REPEAT_THRESHOLD or more times (the usual sign of an N+1 query)
+- a warning with every statement shape, count and time when the request
+  took longer than SQL_SLOW_REQUEST_MS
+
+Configure with:
+
+- SQL_INSTRUMENTATION: turn it all on (default off)
+- SQL_SLOW_REQUEST_MS: slow-request threshold (default 500)
+- SQL_REPEAT_THRESHOLD: repeats of one statement that count as N+1
+  (default 5)
+"""
+
+import json
+import logging
+import re
+import time
+from collections import defaultdict
+
+from flask import g, has_request_context, request
+from sqlalchemy.engine import Engine
+
+from models import db
+
+logger = logging.getLogger('warbler.sql')
+
+# IN lists are expanded into one parameter per value; fold them so the
+# same query with a different number of ids has the same shape
+_IN_LIST = re.compile(r'\bIN \((%\(\w+\)s|\?)(, ?(%\(\w+\)s|\?))*\)',
+                      re.IGNORECASE)
+_WHITESPACE = re.compile(r'\s+')
+
+
+def statement_shape(statement):
+    """`statement` with whitespace and expanded IN lists normalized."""
+
+    return _IN_LIST.sub('IN (...)', _WHITESPACE.sub(' ', statement).strip())
+
+
+class RequestStats:
+    """SQL statements run while handling one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.shapes = defaultdict(lambda: [0, 0.0])
+
+    def record(self, statement, seconds):
+        self.statements += 1
+        self.db_seconds += seconds
+        shape = self.shapes[statement_shape(statement)]
+        shape[0] += 1
+        shape[1] += seconds
+
+    def repeated(self, threshold):
+        """`(shape, count)` for statements run `threshold` or more times."""
+
+        return [(shape, count) for shape, (count, _) in self.shapes.items()
+                if count >= threshold]
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if has_request_context() and 'sql_stats' in g:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    started = conn.info.get('query_started')
+    if started and has_request_context() and 'sql_stats' in g:
+        g.sql_stats.record(statement, time.perf_counter() - started.pop())
+
+
+def init_app(app):
+    """Hook the instrumentation into `app` and its database engines.
+
+    The hooks are always installed but do nothing unless
+    SQL_INSTRUMENTATION is set, so it can be switched on at runtime.
+    They listen on every engine, including replica engines created later
+    by replicas.connect().
+    """
+
+    if not db.event.contains(Engine, 'before_cursor_execute',
+                             _before_cursor_execute):
+        db.event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        db.event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    @app.before_request
+    def start_sql_stats():
+        if app.config.get('SQL_INSTRUMENTATION'):
+            g.sql_stats = RequestStats()
+
+    @app.after_request
+    def report_sql_stats(resp):
+        stats = g.pop('sql_stats', None)
+        if stats is None:
+            return resp
+
+        total_ms = (time.perf_counter() - stats.started) * 1000
+        db_ms = stats.db_seconds * 1000
+
+        resp.headers.add(
+            'Server-Timing',
+            f'db;dur={db_ms:.1f};desc="{stats.statements} statements", '
+            f'total;dur={total_ms:.1f}')
+
+        line = {
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': resp.status_code,
+            'duration_ms': round(total_ms, 1),
+            'db_ms': round(db_ms, 1),
+            'statements': stats.statements,
+        }
+        logger.info(json.dumps(line))
+
+        for shape, count in stats.repeated(
+                app.config.get('SQL_REPEAT_THRESHOLD', 5)):
+            logger.warning(json.dumps(dict(line, repeated=count,
+                                           statement=shape)))
+
+        if total_ms >= app.config.get('SQL_SLOW_REQUEST_MS', 500):
+            detail = [{'statement': shape, 'count': count,
+                       'db_ms': round(seconds * 1000, 1)}
+                      for shape, (count, seconds) in sorted(
+                          stats.shapes.items(), key=lambda item: -item[1][1])]
+            logger.warning(json.dumps(dict(line, slow=True, detail=detail)))
+
+        return resp
@@ -0,0 +1,185 @@
+"""Schema migrations for existing Warbler databases.
+
+New databases get the current schema straight from `db.create_all()` (see
+connect_db). Databases created before a schema change are brought up to
+date with:
+
+    flask migrate
+
+Each migration runs once, in order, in its own transaction, and is recorded
+in the `schema_migrations` table. Migrations check for their change before
+making it, so on a database that already has it (e.g. a fresh one) they
+are simply recorded.
+
+Migrations run against the current models, so columns are added before any
+step that reads or writes rows through them.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import inspect, select, text
+
+from models import (db, Follows, Likes, Message, MESSAGES_FTS_DDL, TimelineEntry,
+                    User, USERS_FTS_DDL)
+from tasks import Job
+from timeline import rebuild_timelines
+
+# (version, description, function taking a connection), in order
+MIGRATIONS = []
+
+
+class SchemaMigration(db.Model):
+    """A migration that has been applied to this database."""
+
+    __tablename__ = 'schema_migrations'
+
+    version = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    applied_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+def migration(version, description):
+    """Register the decorated function as migration `version`."""
+
+    def register(step):
+        MIGRATIONS.append((version, description, step))
+        return step
+    return register
+
+
+def _add_column(conn, table, name, ddl):
+    if name not in {column['name'] for column in inspect(conn).get_columns(table)}:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+
+
+def _create_indexes(conn, table, *names):
+    for index in table.indexes:
+        if index.name in names:
+            index.create(bind=conn, checkfirst=True)
+
+
+@migration('0001', "add user counters and row version")
+def add_user_counters(conn):
+    for name in ('messages_count', 'following_count', 'followers_count',
+                 'likes_count'):
+        _add_column(conn, 'users', name, "INTEGER NOT NULL DEFAULT 0")
+    _add_column(conn, 'users', 'updated_at', "TIMESTAMP")
+    # reconciling reads users.deleted_at, added by 0007
+    _add_column(conn, 'users', 'deleted_at', "TIMESTAMP")
+    User.reconcile_counts()
+
+
+@migration('0002', "materialize home timelines")
+def add_timelines(conn):
+    TimelineEntry.__table__.create(bind=conn, checkfirst=True)
+    # connect_db creates the table, but empty
+    if conn.execute(select(TimelineEntry.user_id).limit(1)).first() is None:
+        rebuild_timelines()
+
+
+@migration('0003', "add full-text search indexes")
+def add_search_indexes(conn):
+    if conn.dialect.name == 'postgresql':
+        _create_indexes(conn, User.__table__, 'ix_users_search')
+        _create_indexes(conn, Message.__table__, 'ix_messages_search')
+        return
+
+    tables = inspect(conn).get_table_names()
+    for name, ddl in [('users_fts', USERS_FTS_DDL),
+                      ('messages_fts', MESSAGES_FTS_DDL)]:
+        if name not in tables:
+            for statement in ddl:
+                conn.execute(text(statement))
+            # index the rows that predate the table
+            conn.execute(text(f"INSERT INTO {name} ({name}) VALUES ('rebuild')"))
+
+
+@migration('0004', "let many users like a message, once each")
+def likes_unique_per_user(conn):
+    unique = {tuple(constraint['column_names']): constraint['name']
+              for constraint in inspect(conn).get_unique_constraints('likes')}
+
+    if ('message_id',) in unique:
+        if conn.dialect.name == 'sqlite':
+            # SQLite can't drop a constraint: copy into a fresh table
+            conn.execute(text("ALTER TABLE likes RENAME TO likes_old"))
+            Likes.__table__.create(bind=conn)
+            conn.execute(text("INSERT INTO likes (id, user_id, message_id) "
+                              "SELECT id, user_id, message_id FROM likes_old"))
+            conn.execute(text("DROP TABLE likes_old"))
+            return
+
+        conn.execute(text(
+            f"ALTER TABLE likes DROP CONSTRAINT {unique[('message_id',)]}"))
+
+    if ('user_id', 'message_id') not in unique:
+        conn.execute(text("ALTER TABLE likes ADD CONSTRAINT "
+                          "likes_user_id_message_id_key UNIQUE (user_id, message_id)"))
+    _create_indexes(conn, Likes.__table__, 'ix_likes_message_id')
+
+
+@migration('0005', "add messages.like_count")
+def add_message_like_count(conn):
+    _add_column(conn, 'messages', 'like_count', "INTEGER NOT NULL DEFAULT 0")
+    # reconciling reads users.deleted_at, added by 0007
+    _add_column(conn, 'users', 'deleted_at', "TIMESTAMP")
+    Message.reconcile_like_counts()
+
+
+@migration('0006', "index messages by author and follows by follower")
+def add_hot_path_indexes(conn):
+    _create_indexes(conn, Message.__table__, 'ix_messages_user_timestamp')
+    _create_indexes(conn, Follows.__table__, 'ix_follows_following')
+
+
+@migration('0007', "add users.deleted_at for background purges")
+def add_user_deleted_at(conn):
+    _add_column(conn, 'users', 'deleted_at', "TIMESTAMP")
+
+
+@migration('0008', "add the background job queue")
+def add_jobs(conn):
+    Job.__table__.create(bind=conn, checkfirst=True)
+
+
+@migration('0009', "index timeline entries by author")
+def add_timeline_author_index(conn):
+    _create_indexes(conn, TimelineEntry.__table__, 'ix_timeline_entries_author')
+
+
+def applied():
+    """Versions already applied to this database."""
+
+    SchemaMigration.__table__.create(bind=db.session.connection(), checkfirst=True)
+    return set(db.session.scalars(select(SchemaMigration.version)))
+
+
+def upgrade():
+    """Apply every pending migration; returns the `(version, description)`
+    of each one applied."""
+
+    done = applied()
+    db.session.commit()
+
+    ran = []
+    for version, description, step in MIGRATIONS:
+        if version in done:
+            continue
+
+        try:
+            step(db.session.connection())
+            db.session.add(SchemaMigration(version=version))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        ran.append((version, description))
+
+    return ran
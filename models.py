@@ -4,9 +4,22 @@ from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+# registers the to_tsvector()/ts_rank() types used by the search index
+import sqlalchemy.dialects.postgresql  # noqa: F401
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import NoResultFound
+
+from passwords import check_password, hash_password, needs_rehash
+from replicas import RoutingSession
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+# INSERT constructs that support ON CONFLICT DO NOTHING, by dialect
+CONFLICT_INSERTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert,
+}
 
 
 class Follows(db.Model):
@@ -26,6 +39,113 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # the primary key serves "who follows X"; this serves "who does X
+    # follow" without touching the table
+    __table_args__ = (
+        db.Index('ix_follows_following',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
+    @classmethod
+    def follow(cls, follower_id, followed_id):
+        """Have `follower_id` follow `followed_id`, and count it.
+
+        A single INSERT ... ON CONFLICT DO NOTHING: following someone
+        already followed (or two racing requests) changes nothing. Returns
+        whether the follow is new. Raises NoResultFound if `followed_id`
+        doesn't exist or is hidden for deletion (see purge.py), and
+        IntegrityError if either user goes away meanwhile.
+        """
+
+        if not User.visible_ids([followed_id]):
+            raise NoResultFound(f"no user {followed_id} to follow")
+
+        if not insert_ignore(cls, user_following_id=follower_id,
+                             user_being_followed_id=followed_id):
+            return False
+
+        User.adjust_counts(follower_id, following_count=1)
+        User.adjust_counts(followed_id, followers_count=1)
+        return True
+
+    @classmethod
+    def unfollow(cls, follower_id, followed_id):
+        """Have `follower_id` stop following `followed_id`, and count it.
+
+        A single DELETE by primary key; a no-op if there was no follow.
+        Returns whether a follow was removed.
+        """
+
+        result = db.session.execute(
+            db.delete(cls)
+            .where(cls.user_following_id == follower_id)
+            .where(cls.user_being_followed_id == followed_id))
+        if not result.rowcount:
+            return False
+
+        # hidden users were taken out of the counters when they were hidden
+        if User.visible_ids([followed_id]):
+            User.adjust_counts(follower_id, following_count=-1)
+            User.adjust_counts(followed_id, followers_count=-1)
+        return True
+
+    @classmethod
+    def follow_many(cls, follower_id, user_ids):
+        """Have `follower_id` follow each of `user_ids`, and count them.
+
+        One query finds which of `user_ids` exist, and one multi-row INSERT
+        ... ON CONFLICT DO NOTHING adds the follows that are new. Returns
+        `(followed, missing)`: the ids newly followed and the ids with no
+        user to follow (none, hidden for deletion, or `follower_id`
+        itself); the rest were already followed.
+        """
+
+        user_ids = list(dict.fromkeys(user_ids))
+        existing = User.visible_ids(user_id for user_id in user_ids
+                                    if user_id != follower_id)
+
+        followed = insert_ignore_many(
+            cls,
+            [{'user_following_id': follower_id, 'user_being_followed_id': user_id}
+             for user_id in user_ids if user_id in existing],
+            returning=cls.user_being_followed_id)
+        cls._count_follows(follower_id, followed, 1)
+
+        return followed, [user_id for user_id in user_ids if user_id not in existing]
+
+    @classmethod
+    def unfollow_many(cls, follower_id, user_ids):
+        """Have `follower_id` stop following each of `user_ids`, and count it.
+
+        One DELETE; returns the ids that were actually unfollowed.
+        """
+
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return []
+
+        unfollowed = list(db.session.scalars(
+            db.delete(cls)
+            .where(cls.user_following_id == follower_id)
+            .where(cls.user_being_followed_id.in_(user_ids))
+            .returning(cls.user_being_followed_id)))
+        # hidden users were taken out of the counters when they were hidden
+        visible = User.visible_ids(unfollowed)
+        cls._count_follows(follower_id,
+                           [user_id for user_id in unfollowed if user_id in visible], -1)
+
+        return unfollowed
+
+    @classmethod
+    def _count_follows(cls, follower_id, followed_ids, delta):
+        if not followed_ids:
+            return
+
+        User.adjust_counts(follower_id, following_count=delta * len(followed_ids))
+        User.query.filter(User.id.in_(followed_ids)).update(
+            {User.followers_count: User.followers_count + delta},
+            synchronize_session=False)
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -45,7 +165,103 @@ class Likes(db.Model):
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        index=True
+    )
+
+    # a user likes a message at most once; also serves lookups by user_id
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id',
+                            name='likes_user_id_message_id_key'),
+    )
+
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Like `message_id` for `user_id`, or unlike it if already liked.
+
+        Either way it's a single statement on `likes`, so concurrent
+        toggles can't double-insert or double-count. Returns True if the
+        message is now liked. Raises NoResultFound if the message doesn't
+        exist or its author is hidden for deletion (see purge.py), and
+        IntegrityError if it goes away meanwhile.
+        """
+
+        visible = db.session.scalar(
+            db.select(Message.id)
+            .join(User, User.id == Message.user_id)
+            .where(Message.id == message_id)
+            .where(User.deleted_at.is_(None)))
+        if visible is None:
+            raise NoResultFound(f"no message {message_id} to like")
+
+        unliked = db.session.execute(
+            db.delete(cls)
+            .where(cls.user_id == user_id)
+            .where(cls.message_id == message_id)
+            .returning(cls.id)).first()
+        if unliked:
+            User.adjust_counts(user_id, likes_count=-1)
+            Message.adjust_like_count(message_id, -1)
+            return False
+
+        if insert_ignore(cls, user_id=user_id, message_id=message_id):
+            User.adjust_counts(user_id, likes_count=1)
+            Message.adjust_like_count(message_id, 1)
+        return True
+
+    @classmethod
+    def counts_for(cls, message_ids):
+        """Exact like counts for `message_ids`, in one grouped query.
+
+        Returns a dict of message id -> count; messages nobody likes are
+        left out. Pages normally show the cheaper Message.like_count.
+        """
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return {}
+
+        rows = db.session.execute(
+            db.select(cls.message_id, db.func.count())
+            .where(cls.message_id.in_(message_ids))
+            .group_by(cls.message_id))
+        return dict(rows.all())
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into one user's home timeline."""
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+        index=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    # copied from the message so a timeline page is one index range scan
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    # the second serves unfollows, purges and the author_id cascade
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+        db.Index('ix_timeline_entries_author', 'author_id', 'user_id'),
     )
 
 
@@ -94,7 +310,54 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message', backref="user")
+    # denormalized stats, kept current by the routes that change them
+    # (see adjust_counts) and repaired by reconcile_counts
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # row version for conditional GETs: set by every UPDATE of the row,
+    # including the counter UPDATEs; NULL for bulk-loaded rows never changed
+    updated_at = db.Column(
+        db.DateTime,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+    )
+
+    # set when an account too big to delete at once is hidden, pending its
+    # purge (see purge.py)
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    # rows that reference a user or message are removed by their foreign
+    # keys' ON DELETE CASCADE; passive_deletes stops the ORM loading them
+    # first when one is deleted through the session
+    messages = db.relationship('Message', backref="user", passive_deletes=True)
 
     followers = db.relationship(
         "User",
@@ -103,6 +366,7 @@ class User(db.Model):
         secondaryjoin=(Follows.user_following_id == id),
         back_populates="following",  # Use back_populates instead of backref ##kept throwing an integrity error
         overlaps="following",
+        passive_deletes=True,
     )
 
     following = db.relationship(
@@ -112,29 +376,197 @@ class User(db.Model):
         secondaryjoin=(Follows.user_being_followed_id == id),
         back_populates="followers",  # Use back_populates instead of backref
         overlaps="followers",
+        passive_deletes=True,
     )
 
 
     likes = db.relationship(
         'Message',
         secondary="likes",
-        backref = 'liked_by'
+        backref=db.backref('liked_by', passive_deletes=True),
+        passive_deletes=True,
     )
 
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    @classmethod
+    def visible(cls):
+        """Query of users that haven't been deleted (or hidden for purging)."""
+
+        return cls.query.filter(cls.deleted_at.is_(None))
+
+    @classmethod
+    def visible_ids(cls, user_ids):
+        """The ids among `user_ids` of users that exist and aren't hidden."""
+
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+
+        return set(db.session.scalars(
+            db.select(cls.id)
+            .where(cls.id.in_(user_ids))
+            .where(cls.deleted_at.is_(None))))
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.query(
+            Follows.query
+            .filter_by(user_being_followed_id=self.id,
+                       user_following_id=other_user.id)
+            .exists()
+        ).scalar()
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.query(
+            Follows.query
+            .filter_by(user_being_followed_id=other_user.id,
+                       user_following_id=self.id)
+            .exists()
+        ).scalar()
+
+    def following_ids_among(self, user_ids):
+        """Which of `user_ids` does this user follow?
+
+        One query for a whole page of users; returns a set so templates can
+        check membership without touching `self.following`.
+        """
+
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+
+        rows = (db.session.query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id)
+                .filter(Follows.user_being_followed_id.in_(user_ids)))
+        return {user_id for (user_id,) in rows}
+
+    def liked_ids_among(self, message_ids):
+        """Which of `message_ids` has this user liked? Returns a set."""
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return set()
+
+        rows = (db.session.query(Likes.message_id)
+                .filter(Likes.user_id == self.id)
+                .filter(Likes.message_id.in_(message_ids)))
+        return {message_id for (message_id,) in rows}
+
+    @classmethod
+    def adjust_counts(cls, user_id, **deltas):
+        """Add `deltas` to this user's counter columns in one UPDATE.
+
+        e.g. `User.adjust_counts(5, followers_count=1)`. Runs in the caller's
+        transaction, so it commits (or rolls back) with the change it counts.
+        """
+
+        values = {getattr(cls, name): getattr(cls, name) + delta
+                  for name, delta in deltas.items()}
+        cls.query.filter(cls.id == user_id).update(values)
+
+    @classmethod
+    def discount_relations(cls, user_id):
+        """Take `user_id` out of every other user's counters.
+
+        Call before deleting the user: their followers follow one fewer
+        account, the accounts they follow lose a follower, anyone who
+        liked their messages has fewer likes, and the messages they liked
+        have one like fewer.
+        """
+
+        their_likes = db.select(Likes.message_id).where(Likes.user_id == user_id)
+        Message.query.filter(Message.id.in_(their_likes)).update(
+            {Message.like_count: Message.like_count - 1},
+            synchronize_session=False)
+
+        followers = (db.select(Follows.user_following_id)
+                     .where(Follows.user_being_followed_id == user_id))
+        cls.query.filter(cls.id.in_(followers)).update(
+            {cls.following_count: cls.following_count - 1},
+            synchronize_session=False)
+
+        followed = (db.select(Follows.user_being_followed_id)
+                    .where(Follows.user_following_id == user_id))
+        cls.query.filter(cls.id.in_(followed)).update(
+            {cls.followers_count: cls.followers_count - 1},
+            synchronize_session=False)
+
+        liked = (db.select(Likes.user_id)
+                 .join(Message, Message.id == Likes.message_id)
+                 .where(Message.user_id == user_id))
+        liked_here = (db.select(db.func.count())
+                      .select_from(Likes)
+                      .join(Message, Message.id == Likes.message_id)
+                      .where(Message.user_id == user_id)
+                      .where(Likes.user_id == cls.id)
+                      .scalar_subquery())
+        cls.query.filter(cls.id.in_(liked)).update(
+            {cls.likes_count: cls.likes_count - liked_here},
+            synchronize_session=False)
+
+    @classmethod
+    def discount_message(cls, message):
+        """Take `message` out of its author's and its likers' counters.
+
+        Call before deleting the message.
+        """
+
+        cls.adjust_counts(message.user_id, messages_count=-1)
+
+        likers = db.select(Likes.user_id).where(Likes.message_id == message.id)
+        cls.query.filter(cls.id.in_(likers)).update(
+            {cls.likes_count: cls.likes_count - 1},
+            synchronize_session=False)
+
+    @classmethod
+    def reconcile_counts(cls):
+        """Recompute every user's counters from the source tables.
+
+        Returns how many users had drifted and were repaired. Users hidden
+        for deletion (see purge.py), and rows linking to them, are left
+        out, as discount_relations() left them out.
+        """
+
+        def counts(column, *criteria):
+            return (db.select(column.label('user_id'),
+                              db.func.count().label('n'))
+                    .where(*criteria)
+                    .group_by(column)
+                    .subquery())
+
+        hidden = db.select(cls.id).where(cls.deleted_at.is_not(None))
+        hidden_messages = db.select(Message.id).where(Message.user_id.in_(hidden))
+
+        # one grouped pass per table rather than a count per user
+        sources = {
+            cls.messages_count: counts(Message.user_id),
+            cls.following_count: counts(Follows.user_following_id,
+                                        Follows.user_being_followed_id.not_in(hidden)),
+            cls.followers_count: counts(Follows.user_being_followed_id,
+                                        Follows.user_following_id.not_in(hidden)),
+            cls.likes_count: counts(Likes.user_id, Likes.message_id.not_in(hidden_messages)),
+        }
+
+        actual = db.select(cls.id, *(db.func.coalesce(source.c.n, 0)
+                                     .label(column.key)
+                                     for column, source in sources.items()))
+        for source in sources.values():
+            actual = actual.outerjoin(source, source.c.user_id == cls.id)
+        actual = actual.subquery()
+
+        drifted = db.or_(*(column != actual.c[column.key] for column in sources))
+        repair = (db.update(cls)
+                  .where(cls.id == actual.c.id)
+                  .where(cls.deleted_at.is_(None))
+                  .where(drifted)
+                  .values({column: actual.c[column.key] for column in sources}))
+
+        return db.session.execute(repair).rowcount
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -143,7 +575,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hash_password(password)
 
         user = User(
             username=username,
@@ -164,13 +596,20 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the stored hash was made at a different bcrypt cost than is now
+        configured, it is replaced (the caller commits).
+
+        Hashing runs on the password pool and may raise PasswordPoolBusy.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.visible().filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = check_password(user.password, password)
             if is_auth:
+                if needs_rehash(user.password):
+                    user.password = hash_password(password)
                 return user
 
         return False
@@ -194,7 +633,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -203,6 +642,184 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # denormalized, kept current by Likes.toggle and repaired by
+    # reconcile_like_counts
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # a user's messages, newest first: profiles, the API and follow backfill
+    __table_args__ = (
+        db.Index('ix_messages_user_timestamp', 'user_id', 'timestamp', 'id'),
+    )
+
+    @classmethod
+    def adjust_like_count(cls, message_id, delta):
+        """Add `delta` to a message's like_count in one UPDATE."""
+
+        cls.query.filter(cls.id == message_id).update(
+            {cls.like_count: cls.like_count + delta})
+
+    @classmethod
+    def reconcile_like_counts(cls):
+        """Recompute every message's like_count from the likes table.
+
+        Returns how many messages had drifted and were repaired. Likes by
+        users hidden for deletion (see purge.py) aren't counted.
+        """
+
+        hidden = db.select(User.id).where(User.deleted_at.is_not(None))
+
+        # one grouped pass over likes rather than a count per message
+        counts = (db.select(Likes.message_id, db.func.count().label('n'))
+                  .where(Likes.user_id.not_in(hidden))
+                  .group_by(Likes.message_id)
+                  .subquery())
+        actual = (db.select(cls.id, db.func.coalesce(counts.c.n, 0).label('n'))
+                  .outerjoin(counts, counts.c.message_id == cls.id)
+                  .subquery())
+
+        repair = (db.update(cls)
+                  .where(cls.id == actual.c.id)
+                  .where(cls.like_count != actual.c.n)
+                  .values(like_count=actual.c.n))
+        return db.session.execute(repair).rowcount
+
+
+##############################################################################
+# Full-text search indexes
+#
+# PostgreSQL: a GIN index on a weighted tsvector expression. SQLite (local
+# and test runs): an FTS5 table kept in sync with triggers.
+
+SEARCH_CONFIG = db.text("'simple'::regconfig")
+
+
+def user_search_document():
+    """Weighted tsvector of a user's username (A), location (B) and bio (C).
+
+    The GIN index below is built on exactly this expression; queries must
+    use it verbatim for PostgreSQL to pick the index.
+    """
+
+    def weighted(column, weight):
+        value = db.func.coalesce(column, db.text("''"))
+        return db.func.setweight(db.func.to_tsvector(SEARCH_CONFIG, value),
+                                 db.text(f"'{weight}'"))
+
+    columns = User.__table__.c
+    return (weighted(columns.username, 'A')
+            .op('||')(weighted(columns.location, 'B'))
+            .op('||')(weighted(columns.bio, 'C')))
+
+
+db.Index('ix_users_search', user_search_document(),
+         postgresql_using='gin').ddl_if(dialect='postgresql')
+
+USERS_FTS_DDL = [
+    """CREATE VIRTUAL TABLE users_fts USING fts5(
+           username, bio, location, content='users', content_rowid='id')""",
+    """CREATE TRIGGER users_fts_insert AFTER INSERT ON users BEGIN
+           INSERT INTO users_fts (rowid, username, bio, location)
+           VALUES (new.id, new.username, new.bio, new.location);
+       END""",
+    """CREATE TRIGGER users_fts_delete AFTER DELETE ON users BEGIN
+           INSERT INTO users_fts (users_fts, rowid, username, bio, location)
+           VALUES ('delete', old.id, old.username, old.bio, old.location);
+       END""",
+    """CREATE TRIGGER users_fts_update AFTER UPDATE ON users BEGIN
+           INSERT INTO users_fts (users_fts, rowid, username, bio, location)
+           VALUES ('delete', old.id, old.username, old.bio, old.location);
+           INSERT INTO users_fts (rowid, username, bio, location)
+           VALUES (new.id, new.username, new.bio, new.location);
+       END""",
+]
+
+for ddl in USERS_FTS_DDL:
+    db.event.listen(User.__table__, 'after_create',
+                    db.DDL(ddl).execute_if(dialect='sqlite'))
+
+db.event.listen(User.__table__, 'before_drop',
+                db.DDL("DROP TABLE IF EXISTS users_fts").execute_if(dialect='sqlite'))
+
+
+MESSAGE_SEARCH_CONFIG = db.text("'english'::regconfig")
+
+
+def message_search_document():
+    """Stemmed tsvector of a message's text; the GIN index is built on it."""
+
+    return db.func.to_tsvector(MESSAGE_SEARCH_CONFIG, Message.__table__.c.text)
+
+
+db.Index('ix_messages_search', message_search_document(),
+         postgresql_using='gin').ddl_if(dialect='postgresql')
+
+MESSAGES_FTS_DDL = [
+    """CREATE VIRTUAL TABLE messages_fts USING fts5(
+           text, content='messages', content_rowid='id', tokenize='porter')""",
+    """CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+           INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+       END""",
+    """CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+           INSERT INTO messages_fts (messages_fts, rowid, text)
+           VALUES ('delete', old.id, old.text);
+       END""",
+    """CREATE TRIGGER messages_fts_update AFTER UPDATE OF text ON messages BEGIN
+           INSERT INTO messages_fts (messages_fts, rowid, text)
+           VALUES ('delete', old.id, old.text);
+           INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+       END""",
+]
+
+for ddl in MESSAGES_FTS_DDL:
+    db.event.listen(Message.__table__, 'after_create',
+                    db.DDL(ddl).execute_if(dialect='sqlite'))
+
+db.event.listen(Message.__table__, 'before_drop',
+                db.DDL("DROP TABLE IF EXISTS messages_fts").execute_if(dialect='sqlite'))
+
+
+def _conflict_insert(model):
+    dialect = db.session.get_bind().dialect.name
+    if dialect not in CONFLICT_INSERTS:
+        raise NotImplementedError(f"insert_ignore doesn't support {dialect}")
+
+    return CONFLICT_INSERTS[dialect](model)
+
+
+def insert_ignore(model, **values):
+    """INSERT a `model` row unless it would break a unique key.
+
+    `INSERT ... ON CONFLICT DO NOTHING` on PostgreSQL and SQLite. Returns
+    whether a row was inserted.
+    """
+
+    result = db.session.execute(
+        _conflict_insert(model).values(**values).on_conflict_do_nothing())
+    return result.rowcount > 0
+
+
+def insert_ignore_many(model, rows, returning):
+    """INSERT every row in `rows` (dicts) that doesn't break a unique key.
+
+    One multi-row `INSERT ... ON CONFLICT DO NOTHING`. Returns the
+    `returning` column of each row actually inserted.
+    """
+
+    if not rows:
+        return []
+
+    return list(db.session.scalars(
+        _conflict_insert(model).values(rows).on_conflict_do_nothing()
+        .returning(returning)))
+
+
+def _enable_foreign_keys(dbapi_connection, connection_record):
+    dbapi_connection.execute("PRAGMA foreign_keys = ON")
 
 
 def connect_db(app):
@@ -213,4 +830,7 @@ def connect_db(app):
     with app.app_context():
         db.app = app
         db.init_app(app)
+        if db.engine.dialect.name == 'sqlite':
+            # SQLite only honours ON DELETE CASCADE when asked to
+            db.event.listen(db.engine, 'connect', _enable_foreign_keys)
         db.create_all()
@@ -0,0 +1,89 @@
+"""Keyset (cursor) pagination helpers for message lists.
+
+Pages are ordered newest first on `(timestamp, id)`. The cursor handed to
+clients is an opaque token for the last row of a page; the next page is
+every row strictly older than it, which stays an index range scan no matter
+how deep the user scrolls.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+
+def _encode(raw):
+    return urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _decode(token):
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        value, row_id = urlsafe_b64decode(padded).decode('utf-8').split('|')
+        return value, int(row_id)
+    except (TypeError, ValueError, UnicodeDecodeError) as err:
+        raise ValueError(f"Invalid cursor: {token!r}") from err
+
+
+def encode_cursor(timestamp, row_id):
+    """Make an opaque `?before=` token for a `(timestamp, id)` position."""
+
+    return _encode(f"{timestamp.isoformat()}|{row_id}")
+
+
+def decode_cursor(token):
+    """Turn a `?before=` token back into `(timestamp, id)`.
+
+    Raises ValueError if the token is malformed.
+    """
+
+    timestamp, row_id = _decode(token)
+    return datetime.fromisoformat(timestamp), row_id
+
+
+def encode_rank_cursor(rank, row_id):
+    """Make an opaque `?before=` token for a `(search rank, id)` position."""
+
+    return _encode(f"{rank!r}|{row_id}")
+
+
+def decode_rank_cursor(token):
+    """Turn a ranked-results `?before=` token back into `(rank, id)`.
+
+    Raises ValueError if the token is malformed.
+    """
+
+    rank, row_id = _decode(token)
+    return float(rank), row_id
+
+
+def before(timestamp_col, id_col, cursor):
+    """Filter clause for rows older than `cursor` on `(timestamp, id)`."""
+
+    return tuple_(timestamp_col, id_col) < tuple_(*cursor)
+
+
+def split_ranked_page(results, per_page):
+    """Like split_page, for `(rank, row)` pairs from a ranked search."""
+
+    if len(results) <= per_page:
+        return results, None
+
+    page = results[:per_page]
+    rank, last = page[-1]
+    return page, encode_rank_cursor(rank, last.id)
+
+
+def split_page(rows, per_page):
+    """Split off the extra row fetched to detect a following page.
+
+    Callers query `per_page + 1` rows; returns `(page, next_cursor)` where
+    `next_cursor` is None on the last page.
+    """
+
+    if len(rows) <= per_page:
+        return rows, None
+
+    page = rows[:per_page]
+    last = page[-1]
+    return page, encode_cursor(last.timestamp, last.id)
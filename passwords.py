@@ -0,0 +1,128 @@
+"""Password hashing off the request thread.
+
+bcrypt is deliberately slow (hundreds of ms at cost 12). Instead of running
+it inline in whichever worker thread got the request, hashing and checking
+go through a small bounded thread pool (bcrypt releases the GIL while it
+works). When more than PASSWORD_QUEUE_DEPTH operations are already running
+or waiting, new ones are refused with PasswordPoolBusy straight away, which
+the app turns into a 503, so a login spike can't tie up every worker. A
+request that waits longer than PASSWORD_TIMEOUT for its result gets the
+same 503.
+
+Configure with:
+
+- BCRYPT_LOG_ROUNDS: work factor for new hashes (default 12); existing
+  hashes at another cost are rehashed on the next successful login
+- PASSWORD_POOL_WORKERS: threads doing bcrypt work (default 4)
+- PASSWORD_QUEUE_DEPTH: max running + waiting operations (default 32)
+- PASSWORD_TIMEOUT: seconds a request waits for its result (default 10)
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import bcrypt
+from flask import current_app
+
+DEFAULT_ROUNDS = 12
+
+
+class PasswordPoolBusy(Exception):
+    """Too many password operations are already queued."""
+
+
+class PasswordPool:
+    """A thread pool that refuses work past a fixed queue depth."""
+
+    def __init__(self, workers, depth):
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='bcrypt')
+        self._slots = threading.BoundedSemaphore(depth) if depth else None
+
+    def run(self, func, *args, timeout=None):
+        """Run `func(*args)` on the pool and wait for its result."""
+
+        if self._slots is None or not self._slots.acquire(blocking=False):
+            raise PasswordPoolBusy()
+
+        try:
+            future = self._executor.submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            # still queued: don't run it for nobody
+            future.cancel()
+            raise PasswordPoolBusy() from None
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """This process's pool, created on first use (and again after a fork)."""
+
+    global _pool, _pool_pid
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            config = current_app.config
+            _pool = PasswordPool(workers=config.get('PASSWORD_POOL_WORKERS', 4),
+                                 depth=config.get('PASSWORD_QUEUE_DEPTH', 32))
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def reset_pool():
+    """Drop the pool so the next call rebuilds it from current config."""
+
+    global _pool
+
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+        _pool = None
+
+
+def _rounds():
+    return current_app.config.get('BCRYPT_LOG_ROUNDS', DEFAULT_ROUNDS)
+
+
+def _run(func, *args):
+    return get_pool().run(func, *args,
+                          timeout=current_app.config.get('PASSWORD_TIMEOUT', 10))
+
+
+def hash_password(password):
+    """bcrypt hash of `password` at the configured cost, as a str."""
+
+    salt = bcrypt.gensalt(rounds=_rounds())
+    hashed = _run(bcrypt.hashpw, password.encode('utf-8'), salt)
+    return hashed.decode('utf-8')
+
+
+def check_password(hashed, password):
+    """Does `password` match the bcrypt hash `hashed`?"""
+
+    return _run(bcrypt.checkpw, password.encode('utf-8'), hashed.encode('utf-8'))
+
+
+def needs_rehash(hashed):
+    """Was `hashed` made with a different cost than is configured now?"""
+
+    try:
+        cost = int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        return True
+
+    return cost != _rounds()
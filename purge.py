@@ -0,0 +1,136 @@
+"""Deleting accounts without loading their rows.
+
+Everything that references a user or a message (messages, follows, likes,
+timeline entries) has an ON DELETE CASCADE foreign key, so deleting a
+user is a single DELETE and the database removes the rest. For most
+accounts that's what `delete_user()` does, right away.
+
+An account with more rows than PURGE_CHUNK_SIZE would make that one
+statement (and its transaction) huge. Such an account is instead hidden
+at once (`users.deleted_at`, which every page and login checks) and
+purged by a background job (see tasks.py), a chunk per transaction. To
+purge every hidden account right away instead (e.g. with no workers
+running):
+
+    flask purge-deleted-users
+
+Configure with:
+
+- PURGE_CHUNK_SIZE: rows deleted per transaction, and the size of
+  account deleted in one go (default 500)
+"""
+
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import delete, func, select, tuple_
+
+import tasks
+import timeline
+from models import db, Follows, Likes, Message, TimelineEntry, User
+
+DEFAULT_CHUNK_SIZE = 500
+
+
+def _chunk_size():
+    return current_app.config.get('PURGE_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+
+
+def _capped_count(query):
+    """How many rows `query` finds, counting no further than the chunk size
+    (plus one, to tell "more than" apart)."""
+
+    return (select(func.count())
+            .select_from(query.limit(_chunk_size() + 1).subquery())
+            .scalar_subquery())
+
+
+def delete_user(user_id):
+    """Delete user `user_id`, now or (for big accounts) in the background.
+
+    Other users' counters are adjusted straight away either way. Commits.
+    """
+
+    User.discount_relations(user_id)
+    timeline.catch_up_authors(select(Follows.user_being_followed_id)
+                              .where(Follows.user_following_id == user_id))
+
+    # the counters miss timeline entries and likes on the user's messages
+    counts = db.session.execute(
+        select(User.messages_count + User.following_count
+               + User.followers_count + User.likes_count
+               + _capped_count(select(TimelineEntry.message_id)
+                               .where(TimelineEntry.user_id == user_id))
+               + _capped_count(select(TimelineEntry.message_id)
+                               .where(TimelineEntry.author_id == user_id))
+               + _capped_count(select(Likes.id)
+                               .join(Message, Message.id == Likes.message_id)
+                               .where(Message.user_id == user_id)))
+        .where(User.id == user_id)).scalar()
+
+    if counts is not None and counts > _chunk_size():
+        db.session.execute(
+            db.update(User).where(User.id == user_id)
+            .values(deleted_at=datetime.utcnow()))
+        tasks.enqueue(purge_user, user_id)
+        db.session.commit()
+        return
+
+    db.session.execute(delete(User).where(User.id == user_id))
+    db.session.commit()
+
+
+def _delete_in_chunks(model, key, *criteria):
+    """Delete `model` rows matching `criteria`, `key` values a chunk at a
+    time, committing after each chunk.
+
+    `key` is a column, or a tuple of columns, unique among those rows.
+    """
+
+    columns = key if isinstance(key, tuple) else (key,)
+    while True:
+        keys = db.session.execute(
+            select(*columns).where(*criteria).limit(_chunk_size())).all()
+        if not keys:
+            return
+
+        db.session.execute(delete(model).where(*criteria)
+                           .where(tuple_(*columns).in_(keys)))
+        db.session.commit()
+
+
+@tasks.job(limit=1)
+def purge_user(user_id):
+    """Delete hidden user `user_id`'s rows a chunk at a time, then the user.
+
+    Safe to run again if interrupted. Its counters were already
+    discounted when the user was hidden.
+    """
+
+    # a message's delete would cascade to all its copies and likes at once
+    _delete_in_chunks(TimelineEntry,
+                      (TimelineEntry.user_id, TimelineEntry.message_id),
+                      TimelineEntry.author_id == user_id)
+    _delete_in_chunks(Likes, Likes.id, Likes.message_id.in_(
+        select(Message.id).where(Message.user_id == user_id)))
+    _delete_in_chunks(Message, Message.id, Message.user_id == user_id)
+    _delete_in_chunks(Follows, Follows.user_being_followed_id,
+                      Follows.user_following_id == user_id)
+    _delete_in_chunks(Follows, Follows.user_following_id,
+                      Follows.user_being_followed_id == user_id)
+    _delete_in_chunks(Likes, Likes.message_id, Likes.user_id == user_id)
+    _delete_in_chunks(TimelineEntry, TimelineEntry.message_id,
+                      TimelineEntry.user_id == user_id)
+
+    db.session.execute(delete(User).where(User.id == user_id))
+    db.session.commit()
+
+
+def purge_deleted_users():
+    """Finish purging every hidden user; returns how many there were."""
+
+    user_ids = db.session.scalars(
+        select(User.id).where(User.deleted_at.is_not(None))).all()
+    for user_id in user_ids:
+        purge_user(user_id)
+    return len(user_ids)
@@ -0,0 +1,109 @@
+"""Read replica routing.
+
+When replicas are configured, SELECTs made while handling GETs to the
+read-only pages below go to a replica; everything else (writes, and reads
+anywhere else) goes to the primary. After a user makes a write request
+they read from the primary for a few seconds, so they see their own change
+even if the replicas lag behind.
+
+Configure with:
+
+- DATABASE_REPLICA_URLS: comma-separated replica URIs (unset: no replicas)
+- REPLICA_POOL_SIZE / REPLICA_MAX_OVERFLOW: connection pool per replica
+- REPLICA_PIN_SECONDS: how long a user stays on the primary after a write
+  (default 10)
+
+The primary's pool is sized with DATABASE_POOL_SIZE / DATABASE_MAX_OVERFLOW
+(see app.py).
+"""
+
+import random
+import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine
+from sqlalchemy.sql import Select
+
+# read-only pages that may be served from a replica
+REPLICA_ENDPOINTS = {
+    'homepage',
+    'list_users',
+    'autocomplete_users',
+    'users_show',
+    'show_following',
+    'users_followers',
+    'show_liked_messages',
+    'messages_show',
+    'messages_search',
+    'api.timeline_messages',
+    'api.user_messages',
+    'api.message',
+}
+
+SAFE_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+# session key: until when (epoch seconds) this user reads from the primary
+PIN_KEY = 'primary_until'
+
+
+class RoutingSession(Session):
+    """Session that sends a request's SELECTs to its replica, if it has one."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing and isinstance(clause, Select)
+                and has_request_context() and g.get('replica') is not None):
+            return g.replica
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def engines(app):
+    """`app`'s replica engines; empty if it has none."""
+
+    return app.extensions.get('replicas', [])
+
+
+def connect(app):
+    """(Re)create `app`'s replica engines from its config."""
+
+    for engine in engines(app):
+        engine.dispose()
+
+    options = {name: app.config[key]
+               for name, key in [('pool_size', 'REPLICA_POOL_SIZE'),
+                                 ('max_overflow', 'REPLICA_MAX_OVERFLOW')]
+               if app.config.get(key) is not None}
+    urls = [url.strip() for url in (app.config.get('DATABASE_REPLICA_URLS') or '').split(',')
+            if url.strip()]
+
+    app.extensions['replicas'] = [create_engine(url, **options) for url in urls]
+
+
+def pick_replica():
+    """Choose this request's replica, unless it must read from the primary."""
+
+    replicas = engines(current_app)
+    if (replicas
+            and request.method in SAFE_METHODS
+            and request.endpoint in REPLICA_ENDPOINTS
+            and session.get(PIN_KEY, 0) < time.time()):
+        g.replica = random.choice(replicas)
+    else:
+        g.replica = None
+
+
+def pin_writer(resp):
+    """Keep a user who just wrote on the primary for a little while."""
+
+    if engines(current_app) and request.method not in SAFE_METHODS:
+        session[PIN_KEY] = time.time() + current_app.config.get('REPLICA_PIN_SECONDS', 10)
+    return resp
+
+
+def init_app(app):
+    """Create `app`'s replica engines and route reads to them."""
+
+    connect(app)
+    app.before_request(pick_replica)
+    app.after_request(pin_writer)
@@ -0,0 +1,183 @@
+"""Full-text search for Warbler.
+
+Queries go through the indexes declared in models.py: GIN tsvector indexes
+on PostgreSQL and FTS5 tables on SQLite, so nothing scans with LIKE.
+
+User search prefix-matches every term, so "tuck" finds "tuckerdiane", and
+ranks username matches above location and bio matches. Message search
+matches stemmed words and is keyset-paginated on `(rank, id)`.
+"""
+
+import re
+
+from sqlalchemy import REAL, cast, column, func, literal_column, select, table, text, tuple_
+from sqlalchemy.orm import joinedload
+
+from models import (db, Follows, Message, User, MESSAGE_SEARCH_CONFIG,
+                    SEARCH_CONFIG, message_search_document, user_search_document)
+
+USERS_PER_PAGE = 30
+
+# Ranked results past this page aren't served; refine the query instead.
+MAX_PAGES = 10
+
+AUTOCOMPLETE_LIMIT = 10
+
+MESSAGES_PER_PAGE = 30
+
+# Longer queries are truncated to this many terms.
+MAX_TERMS = 8
+
+
+def search_terms(q):
+    """Split a free-text query into lower-cased word terms.
+
+    Splits on underscores too, the same way the PostgreSQL parser does.
+    """
+
+    return re.findall(r'[^\W_]+', (q or '').lower())[:MAX_TERMS]
+
+
+def _dialect():
+    return db.session.get_bind().dialect.name
+
+
+def _users_pg(terms, limit, offset, username_only=False):
+    weight = 'A' if username_only else ''
+    tsquery = ' & '.join(f"{term}:*{weight}" for term in terms)
+    query = func.to_tsquery(SEARCH_CONFIG, tsquery)
+    document = user_search_document()
+
+    return (User.visible()
+            .filter(document.op('@@')(query))
+            .order_by(func.ts_rank(document, query).desc(), User.id)
+            .offset(offset)
+            .limit(limit)
+            .all())
+
+
+def _users_sqlite(terms, limit, offset, username_only=False):
+    match = ' '.join(f'"{term}"*' for term in terms)
+    if username_only:
+        match = f"username : ({match})"
+
+    statement = text("""
+        SELECT users.* FROM users
+        JOIN users_fts ON users_fts.rowid = users.id
+        WHERE users_fts MATCH :match AND users.deleted_at IS NULL
+        ORDER BY bm25(users_fts, 10.0, 1.0, 5.0), users.id
+        LIMIT :limit OFFSET :offset
+    """).bindparams(match=match, limit=limit, offset=offset)
+    return User.query.from_statement(statement).all()
+
+
+def _users_like(terms, limit, offset, username_only=False):
+    query = User.visible()
+    for term in terms:
+        query = query.filter(User.username.ilike(f"%{term}%"))
+    return query.order_by(User.id).offset(offset).limit(limit).all()
+
+
+def _find_users(terms, limit, offset, username_only=False):
+    if not terms:
+        return []
+
+    finders = {'postgresql': _users_pg, 'sqlite': _users_sqlite}
+    finder = finders.get(_dialect(), _users_like)
+    return finder(terms, limit, offset, username_only)
+
+
+def search_users(q, page=1):
+    """Ranked users matching `q` across username, bio and location.
+
+    Returns `(users, has_more)` for 1-based `page`; pages are capped at
+    MAX_PAGES.
+    """
+
+    page = min(max(page, 1), MAX_PAGES)
+    users = _find_users(search_terms(q),
+                        limit=USERS_PER_PAGE + 1,
+                        offset=(page - 1) * USERS_PER_PAGE)
+
+    has_more = len(users) > USERS_PER_PAGE and page < MAX_PAGES
+    return users[:USERS_PER_PAGE], has_more
+
+
+def autocomplete_users(q):
+    """Users whose username starts with the terms typed so far."""
+
+    return _find_users(search_terms(q), limit=AUTOCOMPLETE_LIMIT, offset=0,
+                       username_only=True)
+
+
+def _message_ranks_pg(terms):
+    query = func.to_tsquery(MESSAGE_SEARCH_CONFIG, ' & '.join(terms))
+    document = message_search_document()
+    # ts_rank is a float4; compare cursors as float4 too so ties are exact
+    rank = cast(func.ts_rank(document, query), REAL)
+    return rank, document.op('@@')(query), None
+
+
+def _message_ranks_sqlite(terms):
+    messages_fts = table('messages_fts', column('rowid'))
+    match = ' '.join(f'"{term}"' for term in terms)
+    # bm25 is lower-is-better; negate it so both backends sort rank DESC
+    rank = -func.bm25(literal_column('messages_fts'))
+    condition = literal_column('messages_fts').op('MATCH')(match)
+    return rank, condition, (messages_fts, messages_fts.c.rowid == Message.id)
+
+
+def search_messages(q, viewer_id=None, before=None):
+    """Ranked messages matching every word in `q`.
+
+    With `viewer_id`, only messages by that user and the people they follow
+    are returned. `before` is a decoded `(rank, id)` cursor. Returns up to
+    MESSAGES_PER_PAGE + 1 `(rank, message)` pairs, best first, so callers
+    can tell whether another page follows.
+    """
+
+    terms = search_terms(q)
+    if not terms:
+        return []
+
+    if _dialect() == 'sqlite':
+        rank, condition, fts_join = _message_ranks_sqlite(terms)
+    else:
+        rank, condition, fts_join = _message_ranks_pg(terms)
+
+    # hidden authors (see purge.py) are left out here, so pages stay full
+    ranked = (select(rank.label('rank'), Message.id.label('id'))
+              .select_from(Message)
+              .join(User, User.id == Message.user_id)
+              .where(User.deleted_at.is_(None))
+              .where(condition))
+    if fts_join is not None:
+        ranked = ranked.join(*fts_join)
+
+    if viewer_id is not None:
+        followed = (select(Follows.user_being_followed_id)
+                    .where(Follows.user_following_id == viewer_id))
+        ranked = ranked.where((Message.user_id == viewer_id)
+                              | Message.user_id.in_(followed))
+
+    ranked = ranked.subquery()
+    page = select(ranked.c.rank, ranked.c.id)
+    if before is not None:
+        rank_before, id_before = before
+        page = page.where(tuple_(ranked.c.rank, ranked.c.id)
+                          < tuple_(cast(rank_before, REAL), id_before))
+
+    keys = db.session.execute(
+        page
+        .order_by(ranked.c.rank.desc(), ranked.c.id.desc())
+        .limit(MESSAGES_PER_PAGE + 1)).all()
+    if not keys:
+        return []
+
+    ids = [message_id for _, message_id in keys]
+    messages = {msg.id: msg for msg in (Message.query
+                                        .options(joinedload(Message.user))
+                                        .filter(Message.id.in_(ids)))
+                if msg.user.deleted_at is None}
+    return [(score, messages[message_id])
+            for score, message_id in keys if message_id in messages]
@@ -0,0 +1,31 @@
+// Toggle likes in place instead of posting the form and re-rendering the
+// whole timeline. Without JavaScript the forms still post normally.
+document.addEventListener('submit', async (evt) => {
+  const form = evt.target.closest('.like-form');
+  if (!form) return;
+  evt.preventDefault();
+
+  const button = form.querySelector('button');
+  button.disabled = true;
+  try {
+    const resp = await fetch(form.action, {
+      method: 'POST',
+      body: new FormData(form),
+      headers: {'X-Requested-With': 'XMLHttpRequest', 'Accept': 'application/json'},
+      credentials: 'same-origin',
+    });
+    if (!resp.ok) {
+      // e.g. logged out or an expired CSRF token: let the page explain
+      window.location.reload();
+      return;
+    }
+
+    const {liked, likes} = await resp.json();
+    button.classList.toggle('btn-warning', liked);
+    button.classList.toggle('btn-outline-warning', !liked);
+    button.querySelector('i').className = liked ? 'fas fa-star' : 'far fa-star';
+    button.querySelector('.like-count').textContent = likes;
+  } finally {
+    button.disabled = false;
+  }
+});
@@ -0,0 +1,268 @@
+"""A small durable job queue, kept in the app's own database.
+
+Work a response shouldn't wait for (timeline fan-out and backfills, big
+account purges, counter reconciliation) is registered as a job kind and
+enqueued from the request:
+
+    @tasks.job(limit=2)
+    def backfill_follows(follower_id, followed_ids): ...
+
+    tasks.enqueue(backfill_follows, user.id, ids)
+    db.session.commit()
+
+`enqueue()` adds a row to the `jobs` table in the caller's transaction, so
+the job exists exactly when the change it follows up on is committed.
+Workers, started with
+
+    flask worker
+
+claim due jobs with SELECT ... FOR UPDATE SKIP LOCKED (on SQLite, which
+locks the whole database, a conditional UPDATE does the same), run each
+in its own transaction, and delete it once it succeeds. A job that raises
+is retried later, backing off exponentially, until it has run
+TASK_MAX_ATTEMPTS times; then it's kept with `failed_at` set for someone
+to look at. A job whose worker died is claimed again once its lease runs
+out. Jobs can therefore run more than once and must be idempotent.
+
+A job kind's `limit` caps how many of it run at once across all workers
+(checked when claiming, so two workers claiming at the same instant can
+briefly go one over).
+
+Configure with:
+
+- TASKS_EAGER: run jobs in-process right after the enqueuing transaction
+  commits, instead of queueing them; their exceptions propagate (default
+  off; handy in tests)
+- TASK_MAX_ATTEMPTS: runs before a job is given up on (default 5)
+- TASK_BACKOFF_SECONDS: delay before the first retry, doubled for each
+  one after (default 10)
+- TASK_LEASE_SECONDS: how long a claimed job may run before another
+  worker may claim it again (default 600)
+- TASK_POLL_SECONDS: how long an idle worker sleeps (default 1)
+- TASK_LIMITS: per-kind concurrency limits overriding the code's, as
+  `kind=n,kind=n`
+"""
+
+import logging
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import func, or_, select, update
+from sqlalchemy.orm import Session
+
+from models import db
+
+logger = logging.getLogger('warbler.tasks')
+
+# kind -> (function, default concurrency limit or None)
+JOBS = {}
+
+
+class Job(db.Model):
+    """A unit of deferred work, waiting, running or given up on."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # positional arguments, as JSON
+    args = db.Column(
+        db.JSON,
+        nullable=False,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # set while a worker runs the job
+    locked_at = db.Column(
+        db.DateTime,
+    )
+
+    # set once the job has used up its attempts
+    failed_at = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    # workers look for the oldest due job
+    __table_args__ = (
+        db.Index('ix_jobs_run_at', 'run_at', 'id'),
+    )
+
+
+def job(limit=None):
+    """Register the decorated function as a job kind, named after it."""
+
+    def register(func):
+        JOBS[func.__name__] = (func, limit)
+        return func
+    return register
+
+
+def enqueue(func, *args):
+    """Queue `func(*args)` in the current transaction; `args` must be JSON."""
+
+    kind = func.__name__
+    if JOBS.get(kind, (None,))[0] is not func:
+        raise ValueError(f"{kind} isn't a registered job")
+
+    if current_app.config.get('TASKS_EAGER'):
+        db.session().info.setdefault('eager_jobs', []).append((kind, list(args)))
+    else:
+        db.session.add(Job(kind=kind, args=list(args)))
+
+
+@db.event.listens_for(Session, 'after_commit')
+def _run_eager_jobs(session):
+    for kind, args in session.info.pop('eager_jobs', []):
+        _run(current_app._get_current_object(), kind, args)
+
+
+@db.event.listens_for(Session, 'after_rollback')
+def _drop_eager_jobs(session):
+    session.info.pop('eager_jobs', None)
+
+
+def _run(app, kind, args):
+    """Run one job in its own app context (so its own session); commits."""
+
+    with app.app_context():
+        func, _ = JOBS[kind]
+        try:
+            func(*args)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+
+def _limits():
+    limits = {kind: limit for kind, (_, limit) in JOBS.items() if limit}
+    limits.update(current_app.config.get('TASK_LIMITS') or {})
+    return limits
+
+
+def claim(kinds=None):
+    """Lock the oldest due job (of `kinds`, if given) and return it, or None.
+
+    Skips kinds that are already running as often as their limit allows.
+    Commits.
+    """
+
+    config = current_app.config
+    now = datetime.utcnow()
+    expired = now - timedelta(seconds=config.get('TASK_LEASE_SECONDS', 600))
+
+    running = dict(db.session.execute(
+        select(Job.kind, func.count())
+        .where(Job.locked_at > expired)
+        .group_by(Job.kind)).all())
+    full = [kind for kind, limit in _limits().items()
+            if running.get(kind, 0) >= limit]
+
+    query = (select(Job)
+             .where(Job.failed_at.is_(None))
+             .where(Job.run_at <= now)
+             .where(or_(Job.locked_at.is_(None), Job.locked_at <= expired)))
+    if full:
+        query = query.where(Job.kind.not_in(full))
+    if kinds:
+        query = query.where(Job.kind.in_(kinds))
+
+    found = db.session.scalars(
+        query
+        .order_by(Job.run_at, Job.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)).first()
+    if found is None:
+        db.session.commit()
+        return None
+
+    claimed = db.session.execute(
+        update(Job)
+        .where(Job.id == found.id)
+        .where(or_(Job.locked_at.is_(None), Job.locked_at <= expired))
+        .values(locked_at=now, attempts=Job.attempts + 1)
+        .execution_options(synchronize_session=False)).rowcount
+    db.session.commit()
+    if not claimed:
+        # another worker got there first (SQLite)
+        return None
+
+    db.session.refresh(found)
+    return found
+
+
+def _finish(job_id, error=None):
+    """Delete a job that ran, or schedule its retry (or give up) if it failed."""
+
+    if error is None:
+        db.session.execute(db.delete(Job).where(Job.id == job_id))
+        db.session.commit()
+        return
+
+    config = current_app.config
+    found = db.session.get(Job, job_id)
+    found.locked_at = None
+    found.last_error = error
+    if found.attempts >= config.get('TASK_MAX_ATTEMPTS', 5):
+        found.failed_at = datetime.utcnow()
+    else:
+        delay = config.get('TASK_BACKOFF_SECONDS', 10) * 2 ** (found.attempts - 1)
+        found.run_at = datetime.utcnow() + timedelta(seconds=delay)
+    db.session.commit()
+
+
+def run_next(kinds=None):
+    """Claim and run one job; returns whether there was one."""
+
+    app = current_app._get_current_object()
+    found = claim(kinds)
+    if found is None:
+        return False
+
+    job_id, kind, args = found.id, found.kind, found.args
+    try:
+        _run(app, kind, args)
+    except Exception:
+        logger.exception("job #%s %s%r failed", job_id, kind, tuple(args))
+        _finish(job_id, traceback.format_exc())
+    else:
+        _finish(job_id)
+    return True
+
+
+def work(burst=False, kinds=None):
+    """Run jobs until stopped; with `burst`, until none are due."""
+
+    app = current_app._get_current_object()
+    while True:
+        with app.app_context():
+            ran = run_next(kinds)
+        if not ran:
+            if burst:
+                return
+            time.sleep(app.config.get('TASK_POLL_SECONDS', 1))
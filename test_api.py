@@ -0,0 +1,192 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+import json
+import os
+from datetime import datetime
+from unittest import TestCase, mock
+
+from models import db, Message, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import api
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# run background jobs (see tasks.py) as soon as their transaction commits
+app.config['TASKS_EAGER'] = True
+
+
+class ApiTestCase(TestCase):
+    """Tests for the /api/v1 routes."""
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.drop_all()
+        db.create_all()
+
+        self.u1 = User.signup(username="reader", email="reader@test.com",
+                              password="password", image_url=None)
+        self.u2 = User.signup(username="writer", email="writer@test.com",
+                              password="password", image_url=None)
+        db.session.commit()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u2.id
+        for n in range(5):
+            self.client.post("/messages/new", data={"text": f"Post {n}"})
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1.id
+        self.client.post(f"/users/follow/{self.u2.id}")
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_timeline_pages_with_cursor(self):
+        """Does the timeline come back newest first, page by page?"""
+        res = self.client.get("/api/v1/timeline?limit=3")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, "application/json")
+
+        page = res.get_json()
+        self.assertEqual([m["text"] for m in page["messages"]],
+                         ["Post 4", "Post 3", "Post 2"])
+        self.assertEqual(page["messages"][0]["user"]["username"], "writer")
+
+        res = self.client.get(f"/api/v1/timeline?limit=3&before={page['next_cursor']}")
+        page = res.get_json()
+        self.assertEqual([m["text"] for m in page["messages"]],
+                         ["Post 1", "Post 0"])
+        self.assertIsNone(page["next_cursor"])
+
+    def test_timeline_pages_stay_full_without_hidden_authors(self):
+        """Are a hidden author's newer posts skipped without losing the cursor?"""
+        u3 = User.signup(username="leaving", email="leaving@test.com",
+                         password="password", image_url=None)
+        db.session.commit()
+        u3_id = u3.id
+        self.client.post(f"/users/follow/{u3_id}")
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = u3_id
+        for n in range(3):
+            self.client.post("/messages/new", data={"text": f"Leaving {n}"})
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1.id
+
+        User.query.get(u3_id).deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        page = self.client.get("/api/v1/timeline?limit=3").get_json()
+        self.assertEqual([m["text"] for m in page["messages"]],
+                         ["Post 4", "Post 3", "Post 2"])
+        self.assertIsNotNone(page["next_cursor"])
+
+    def test_timeline_requires_login(self):
+        """Is an anonymous timeline request a JSON 401?"""
+        res = app.test_client().get("/api/v1/timeline")
+        self.assertEqual(res.status_code, 401)
+        self.assertIn("error", res.get_json())
+
+    def test_user_messages_revalidate(self):
+        """Are a user's messages a 304 until they post again?"""
+        url = f"/api/v1/users/{self.u2.id}/messages"
+        res = self.client.get(url)
+        self.assertEqual(len(res.get_json()["messages"]), 5)
+        etag = res.headers["ETag"]
+
+        self.assertEqual(self.client.get(url, headers={"If-None-Match": etag})
+                         .status_code, 304)
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u2.id
+        self.client.post("/messages/new", data={"text": "Post 5"})
+
+        res = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json()["messages"][0]["text"], "Post 5")
+
+    def test_message_and_errors(self):
+        """Is one message served, and are bad ids/params JSON errors?"""
+        msg = Message.query.filter_by(text="Post 0").one()
+        res = self.client.get(f"/api/v1/messages/{msg.id}")
+        self.assertEqual(res.get_json()["id"], msg.id)
+        self.assertEqual(res.get_json()["timestamp"], msg.timestamp.isoformat())
+
+        self.assertEqual(self.client.get("/api/v1/messages/0").status_code, 404)
+        self.assertEqual(self.client.get("/api/v1/users/0/messages").status_code, 404)
+        res = self.client.get(f"/api/v1/users/{self.u2.id}/messages?before=nope")
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.get_json(), {"error": "Invalid cursor"})
+
+    def test_stdlib_encoder_matches_orjson(self):
+        """Is the output the same with and without orjson?"""
+        msg = Message.query.filter_by(text="Post 0").one()
+        url = f"/api/v1/messages/{msg.id}"
+        fast = self.client.get(url).data
+
+        with mock.patch.object(api, 'orjson', None):
+            self.assertEqual(self.client.get(url).data, fast)
+        self.assertEqual(json.loads(fast)["user"]["id"], self.u2.id)
+
+    def test_bulk_follow(self):
+        """Are many users followed at once, with a result per id?"""
+        u3 = User.signup(username="third", email="third@test.com",
+                         password="password", image_url=None)
+        db.session.commit()
+        db.session.add(Message(text="Third post", user_id=u3.id))
+        db.session.commit()
+        u3_id = u3.id
+        hidden = User.signup(username="leaving", email="leaving@test.com",
+                             password="password", image_url=None)
+        hidden.deleted_at = datetime.utcnow()
+        db.session.commit()
+        hidden_id = hidden.id
+
+        with mock.patch.dict(app.config, TASKS_EAGER=True):
+            res = self.client.post("/api/v1/follows", json={
+                "user_ids": [self.u2.id, u3_id, 0, u3_id, self.u1.id, hidden_id]})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json()["results"], [
+            {"id": self.u2.id, "result": "already_following"},
+            {"id": u3_id, "result": "followed"},
+            {"id": 0, "result": "not_found"},
+            {"id": self.u1.id, "result": "not_found"},
+            {"id": hidden_id, "result": "not_found"},
+        ])
+
+        db.session.expire_all()
+        self.assertEqual(User.query.get(self.u1.id).following_count, 2)
+        self.assertEqual(User.query.get(u3_id).followers_count, 1)
+
+        # the backfill (run inline here) put u3's post on the timeline
+        page = self.client.get("/api/v1/timeline").get_json()
+        self.assertIn("Third post", [m["text"] for m in page["messages"]])
+
+    def test_bulk_unfollow_and_errors(self):
+        """Are many users unfollowed at once, and bad bodies rejected?"""
+        res = self.client.delete("/api/v1/follows", json={
+            "user_ids": [self.u2.id, self.u1.id]})
+        self.assertEqual(res.get_json()["results"], [
+            {"id": self.u2.id, "result": "unfollowed"},
+            {"id": self.u1.id, "result": "not_following"},
+        ])
+        db.session.expire_all()
+        self.assertEqual(User.query.get(self.u2.id).followers_count, 0)
+        self.assertEqual(self.client.get("/api/v1/timeline").get_json()["messages"], [])
+
+        self.assertEqual(self.client.post(
+            "/api/v1/follows", data={"user_ids": self.u2.id}).status_code, 400)
+        self.assertEqual(self.client.post(
+            "/api/v1/follows", json={"user_ids": ["1"]}).status_code, 400)
+        self.assertEqual(app.test_client().post(
+            "/api/v1/follows", json={"user_ids": [self.u2.id]}).status_code, 401)
@@ -0,0 +1,74 @@
+"""Fingerprinted asset tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import assets
+
+
+class AssetsTestCase(TestCase):
+    """Build assets into a scratch directory and serve them."""
+
+    def setUp(self):
+        self.dist = tempfile.mkdtemp()
+        self.manifest = assets.build(app.static_folder, self.dist)
+        app.config['ASSETS_DIR'] = self.dist
+        assets.load_manifest(app)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        del app.config['ASSETS_DIR']
+        assets.load_manifest(app)
+        shutil.rmtree(self.dist)
+
+    def test_build_fingerprints_and_rewrites_css(self):
+        """Do hashed names change with content and CSS point at them?"""
+        css = self.manifest['stylesheets/style.css']
+        self.assertRegex(css, r'^stylesheets/style\.[0-9a-f]{10}\.css$')
+
+        with open(os.path.join(self.dist, css)) as f:
+            content = f.read()
+        self.assertIn(f"/assets/{self.manifest['images/nav-bg.png']}", content)
+        self.assertNotIn("/static/images/", content)
+
+        # images gain nothing from gzip, so they get no variant
+        hero = self.manifest['images/warbler-hero.jpg']
+        self.assertFalse(os.path.exists(os.path.join(self.dist, hero + '.gz')))
+
+    def test_pages_link_fingerprinted_assets(self):
+        """Does the layout link assets through the manifest?"""
+        res = self.client.get("/login")
+        html = res.get_data(as_text=True)
+        self.assertIn(f"/assets/{self.manifest['stylesheets/style.css']}", html)
+
+    def test_serves_precompressed_variant(self):
+        """Is the gzip variant sent, immutable, to clients that accept it?"""
+        url = f"/assets/{self.manifest['stylesheets/style.css']}"
+
+        res = self.client.get(url, headers={"Accept-Encoding": "gzip, deflate"})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers["Content-Encoding"], "gzip")
+        self.assertEqual(res.headers["Content-Type"], "text/css; charset=utf-8")
+        self.assertIn("immutable", res.headers["Cache-Control"])
+        self.assertIn("Accept-Encoding", res.headers["Vary"])
+        plain = gzip.decompress(res.data)
+
+        res = self.client.get(url)
+        self.assertNotIn("Content-Encoding", res.headers)
+        self.assertEqual(res.data, plain)
+        res.close()
+
+    def test_missing_asset_is_404(self):
+        """Are unknown hashes and the manifest itself not served?"""
+        self.assertEqual(self.client.get("/assets/nope.css").status_code, 404)
+        self.assertEqual(self.client.get("/assets/manifest.json").status_code, 404)
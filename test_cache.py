@@ -0,0 +1,70 @@
+"""Cache backend tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from cache import LRUCache, SQLiteCache, make_cache
+
+
+class LRUCacheTestCase(TestCase):
+    """Tests for the in-process cache."""
+
+    def test_evicts_least_recently_used(self):
+        """Does the cache drop the least recently used key when full?"""
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_expires_after_ttl(self):
+        """Are entries dropped once their TTL has passed?"""
+        cache = LRUCache(ttl=10)
+        with mock.patch("cache.time.monotonic", return_value=100):
+            cache.set("a", {"id": 1})
+        with mock.patch("cache.time.monotonic", return_value=105):
+            self.assertEqual(cache.get("a"), {"id": 1})
+        with mock.patch("cache.time.monotonic", return_value=111):
+            self.assertIsNone(cache.get("a"))
+
+
+class SQLiteCacheTestCase(TestCase):
+    """Tests for the cache shared between workers."""
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+
+    def tearDown(self):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def test_entries_are_shared(self):
+        """Do two caches on the same file see each other's writes and deletes?"""
+        worker1 = make_cache(f"sqlite:///{self.path}")
+        worker2 = make_cache(f"sqlite:///{self.path}")
+
+        worker1.set(7, {"username": "testuser"})
+        self.assertEqual(worker2.get(7), {"username": "testuser"})
+
+        worker2.delete(7)
+        self.assertIsNone(worker1.get(7))
+
+    def test_evicts_past_maxsize(self):
+        """Does the shared cache keep at most maxsize entries?"""
+        cache = SQLiteCache(self.path, maxsize=2)
+        for key in "abc":
+            cache.set(key, key)
+
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("c"), "c")
@@ -6,8 +6,8 @@
 
 import os
 from unittest import TestCase
-from models import db, User, Message
-from sqlalchemy.exc import DataError
+from models import db, User, Message, Likes
+from sqlalchemy.exc import DataError, IntegrityError
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -106,3 +106,55 @@ class MessageModelTestCase(TestCase):
             message = Message.query.first()
             self.assertEqual(message.user_id, self.user.id)
             self.assertEqual(message.user.username, self.user.username)
+
+    def test_message_timestamps_are_per_message(self):
+        """Does each message get its own creation timestamp?"""
+        with app.app_context():
+            later = Message(text="Later message", user_id=self.user.id)
+            db.session.add(later)
+            db.session.commit()
+
+            self.assertGreater(later.timestamp, self.message.timestamp)
+
+    def test_like_toggle_is_one_row_per_user(self):
+        """Do toggles flip one (user, message) row and keep likes_count?"""
+        with app.app_context():
+            other = User.signup("otheruser", "other@test.com", "password", None)
+            db.session.commit()
+
+            self.assertTrue(Likes.toggle(self.user.id, self.message.id))
+            self.assertTrue(Likes.toggle(other.id, self.message.id))
+            db.session.commit()
+            self.assertEqual(Likes.counts_for([self.message.id]),
+                             {self.message.id: 2})
+            self.assertEqual(Message.query.get(self.message.id).like_count, 2)
+
+            self.assertFalse(Likes.toggle(self.user.id, self.message.id))
+            db.session.commit()
+            self.assertEqual(Message.query.get(self.message.id).like_count, 1)
+            self.assertEqual(User.query.get(self.user.id).likes_count, 0)
+            self.assertEqual(User.query.get(other.id).likes_count, 1)
+
+            db.session.add(Likes(user_id=other.id, message_id=self.message.id))
+            with self.assertRaises(IntegrityError):
+                db.session.commit()
+
+    def test_like_counts_reconcile_and_follow_deletes(self):
+        """Are like counts repaired, and discounted when a liker leaves?"""
+        with app.app_context():
+            other = User.signup("otheruser", "other@test.com", "password", None)
+            db.session.commit()
+            Likes.toggle(other.id, self.message.id)
+            db.session.commit()
+
+            Message.query.get(self.message.id).like_count = 7
+            db.session.commit()
+            self.assertEqual(Message.reconcile_like_counts(), 1)
+            self.assertEqual(Message.query.get(self.message.id).like_count, 1)
+            self.assertEqual(Message.reconcile_like_counts(), 0)
+
+            User.discount_relations(other.id)
+            db.session.delete(other)
+            db.session.commit()
+            self.assertEqual(Message.query.get(self.message.id).like_count, 0)
+            self.assertEqual(Message.reconcile_like_counts(), 0)
@@ -5,10 +5,14 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 
+import json
 import os
-from unittest import TestCase
+import re
+from datetime import datetime
+from unittest import TestCase, mock
 from flask import session
-from models import db, connect_db, Message, User, Likes
+from sqlalchemy import event
+from models import db, connect_db, Follows, Message, User, Likes, TimelineEntry
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,6 +25,8 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+import instrumentation
+import timeline
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -32,6 +38,9 @@ from app import app, CURR_USER_KEY
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# run background jobs (see tasks.py) as soon as their transaction commits
+app.config['TASKS_EAGER'] = True
+
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -198,6 +207,47 @@ class MessageViewTestCase(TestCase):
                 like = Likes.query.filter_by(user_id=self.u1.id, message_id=self.message_id).first()
                 self.assertIsNone(like)
     
+    def test_like_toggle_json(self):
+        """Does a scripted toggle return the new state and count?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+
+            headers = {"X-Requested-With": "XMLHttpRequest"}
+            res = c.post(f'/users/add_like/{self.message_id}', headers=headers)
+            self.assertEqual(res.get_json(), {"liked": True, "likes": 1})
+
+            res = c.post(f'/users/add_like/{self.message_id}', headers=headers)
+            self.assertEqual(res.get_json(), {"liked": False, "likes": 0})
+
+            res = c.post('/users/add_like/0', headers=headers)
+            self.assertEqual(res.status_code, 404)
+
+            # liking changes state, so it's never a GET
+            self.assertEqual(c.get(f'/users/add_like/{self.message_id}').status_code, 405)
+
+        res = app.test_client().post(f'/users/add_like/{self.message_id}',
+                                     headers=headers)
+        self.assertEqual(res.status_code, 403)
+
+    def test_homepage_shows_like_counts(self):
+        """Do other users' likes show up, and invalidate the page's ETag?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+            c.post(f"/users/follow/{self.u2.id}")
+
+            res = c.get("/")
+            self.assertIn('<span class="like-count">0</span>', res.get_data(as_text=True))
+            etag = res.headers["ETag"]
+
+            Likes.toggle(self.u2.id, self.message_id)
+            db.session.commit()
+
+            res = c.get("/", headers={"If-None-Match": etag})
+            self.assertEqual(res.status_code, 200)
+            self.assertIn('<span class="like-count">1</span>', res.get_data(as_text=True))
+
     def test_like_message_unauthorized(self):
         """Test liking a message without being logged in."""
         with app.app_context():
@@ -206,4 +256,195 @@ class MessageViewTestCase(TestCase):
                 html = res.get_data(as_text=True)
             self.assertEqual(res.status_code, 200)
             self.assertIn("Access unauthorized.",html)
-            self.assertNotIn("A liked message",html)
\ No newline at end of file
+            self.assertNotIn("A liked message",html)
+
+    def test_add_message_fans_out_to_followers(self):
+        """Does a new message show up on a follower's homepage?"""
+        with app.app_context():
+            u1 = User.query.get(self.u1.id)
+            u2 = User.query.get(self.u2.id)
+            u2.following.append(u1)
+            db.session.commit()
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1.id
+                c.post("/messages/new", data={"text": "Fanned out"})
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u2.id
+                res = c.get("/")
+
+            self.assertIn("Fanned out", res.get_data(as_text=True))
+
+    def test_high_fanout_author_is_pulled_at_read_time(self):
+        """Are high-follower accounts merged in without being fanned out?"""
+        app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        try:
+            with app.app_context():
+                # counted, as the fan-out limit is checked against the counter
+                Follows.follow(self.u2.id, self.u1.id)
+                db.session.commit()
+
+                with self.client as c:
+                    with c.session_transaction() as sess:
+                        sess[CURR_USER_KEY] = self.u1.id
+                    c.post("/messages/new", data={"text": "Pulled in"})
+
+                    msg = Message.query.filter_by(text="Pulled in").one()
+                    self.assertEqual(
+                        TimelineEntry.query.filter_by(message_id=msg.id).count(), 1)
+
+                    with c.session_transaction() as sess:
+                        sess[CURR_USER_KEY] = self.u2.id
+                    res = c.get("/")
+
+                self.assertIn("Pulled in", res.get_data(as_text=True))
+        finally:
+            del app.config['TIMELINE_FANOUT_LIMIT']
+
+    def test_author_dropping_below_fanout_limit_is_caught_up(self):
+        """Are messages that were pulled copied out once the author is
+        fanned out again?"""
+        with app.app_context(), mock.patch.dict(app.config, TIMELINE_FANOUT_LIMIT=2):
+            u3 = User.signup("third", "third@test.com", "password", None)
+            db.session.commit()
+            u1_id, u2_id, u3_id = self.u1.id, self.u2.id, u3.id
+            Follows.follow(u2_id, u1_id)
+            Follows.follow(u3_id, u1_id)
+            db.session.commit()
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = u1_id
+                c.post("/messages/new", data={"text": "Pulled, then pushed"})
+                msg_id = Message.query.filter_by(text="Pulled, then pushed").one().id
+                self.assertIsNone(db.session.get(TimelineEntry, (u2_id, msg_id)))
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = u3_id
+                c.post(f"/users/stop-following/{u1_id}")
+
+                self.assertIsNotNone(db.session.get(TimelineEntry, (u2_id, msg_id)))
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = u2_id
+                self.assertIn("Pulled, then pushed", c.get("/").get_data(as_text=True))
+
+
+    def test_homepage_query_count_is_bounded(self):
+        """Does rendering the timeline avoid one query per message author?"""
+        with app.app_context():
+            reader = User.query.get(self.u1.id)
+            for i in range(10):
+                author = User.signup(username=f"author{i}",
+                                     email=f"author{i}@test.com",
+                                     password="password",
+                                     image_url=None)
+                db.session.add(author)
+                db.session.flush()
+                reader.following.append(author)
+                db.session.add(Message(text=f"Author message {i}", user_id=author.id))
+            db.session.commit()
+            timeline.rebuild_timelines()
+            db.session.commit()
+            db.session.expunge_all()
+
+            statements = []
+
+            def count(conn, cursor, statement, *args):
+                statements.append(statement)
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1.id
+
+                event.listen(db.engine, "before_cursor_execute", count)
+                try:
+                    res = c.get("/")
+                finally:
+                    event.remove(db.engine, "before_cursor_execute", count)
+
+            self.assertIn("Author message 9", res.get_data(as_text=True))
+            self.assertLessEqual(len(statements), 6)
+
+    def test_sql_instrumentation(self):
+        """Are statements timed into Server-Timing and the log when enabled?"""
+        with app.app_context():
+            msg = Message(text="Timed message", user_id=self.u1.id)
+            db.session.add(msg)
+            db.session.commit()
+            msg_id = msg.id
+
+        res = self.client.get(f"/messages/{msg_id}")
+        self.assertNotIn("Server-Timing", res.headers)
+
+        config = {'SQL_INSTRUMENTATION': True, 'SQL_REPEAT_THRESHOLD': 1}
+        with mock.patch.dict(app.config, config):
+            with self.assertLogs("warbler.sql", level="INFO") as logs:
+                res = self.client.get(f"/messages/{msg_id}")
+
+        self.assertRegex(res.headers["Server-Timing"],
+                         r'db;dur=[\d.]+;desc="\d+ statements", total;dur=')
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line["endpoint"], "messages_show")
+        self.assertGreater(line["statements"], 0)
+        # with a threshold of 1 every statement is reported as repeated
+        self.assertTrue(any(r.levelname == "WARNING" for r in logs.records))
+
+    def test_statement_shape_folds_in_lists(self):
+        """Do IN lists of different lengths give the same statement shape?"""
+        short = "SELECT * FROM users\n WHERE id IN (%(id_1_1)s)"
+        long = "SELECT * FROM users WHERE id IN (%(id_1_1)s, %(id_1_2)s)"
+        self.assertEqual(instrumentation.statement_shape(short),
+                         "SELECT * FROM users WHERE id IN (...)")
+        self.assertEqual(instrumentation.statement_shape(long),
+                         "SELECT * FROM users WHERE id IN (...)")
+
+    def test_search_messages_pages_through_ties(self):
+        """Does message search page through equally-ranked hits exactly once?"""
+        with app.app_context():
+            for i in range(3):
+                db.session.add(Message(text=f"Potato soup {i}", user_id=self.u2.id))
+            db.session.commit()
+
+            seen = []
+            url = "/messages/search?q=potatoes"
+            with mock.patch('search.MESSAGES_PER_PAGE', 2):
+                while url:
+                    html = self.client.get(url).get_data(as_text=True)
+                    seen += re.findall(r"Potato soup \d", html)
+                    more = re.search(r'href="(/messages/search\?[^"]*before=[^"]+)"', html)
+                    url = more.group(1).replace("&amp;", "&") if more else None
+
+            self.assertEqual(sorted(seen), ["Potato soup 0", "Potato soup 1", "Potato soup 2"])
+
+    def test_search_messages_skips_hidden_authors(self):
+        """Does a hidden author's hit leave the page full and pageable?"""
+        with app.app_context():
+            for i in range(3):
+                db.session.add(Message(text=f"Potato soup {i}", user_id=self.u2.id))
+            db.session.add(Message(text="Potato soup hidden", user_id=self.u1.id))
+            User.query.get(self.u1.id).deleted_at = datetime.utcnow()
+            db.session.commit()
+
+            with mock.patch('search.MESSAGES_PER_PAGE', 2):
+                html = self.client.get("/messages/search?q=potatoes").get_data(as_text=True)
+            self.assertEqual(len(re.findall(r"Potato soup \d", html)), 2)
+            self.assertNotIn("Potato soup hidden", html)
+            self.assertRegex(html, r'href="/messages/search\?[^"]*before=')
+
+    def test_search_messages_following_only(self):
+        """Does following=1 limit results to followed users?"""
+        with app.app_context():
+            db.session.add(Message(text="Ducks everywhere", user_id=self.u2.id))
+            db.session.commit()
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1.id
+
+                html = c.get("/messages/search?q=duck").get_data(as_text=True)
+                self.assertIn("Ducks everywhere", html)
+
+                html = c.get("/messages/search?q=duck&following=1").get_data(as_text=True)
+                self.assertNotIn("Ducks everywhere", html)
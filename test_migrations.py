@@ -0,0 +1,70 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import inspect, text
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from models import db, Likes, Message, User
+import migrations
+
+
+class MigrationsTestCase(TestCase):
+    """Bring an out-of-date schema up to date."""
+
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.drop_all()
+        db.create_all()
+
+        user = User.signup("migrator", "m@test.com", "password", None)
+        db.session.commit()
+        msg = Message(text="Old news", user_id=user.id)
+        db.session.add(msg)
+        db.session.commit()
+        db.session.add(Likes(user_id=user.id, message_id=msg.id))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_upgrade_old_schema(self):
+        """Are missing columns, constraints and indexes added, once?"""
+        self.assertEqual(len(migrations.upgrade()), len(migrations.MIGRATIONS))
+        self.assertEqual(migrations.upgrade(), [])
+
+        # back to before the likes, like count and index changes
+        db.session.execute(text("""
+            ALTER TABLE likes DROP CONSTRAINT likes_user_id_message_id_key;
+            ALTER TABLE likes ADD CONSTRAINT likes_message_id_key UNIQUE (message_id);
+            DROP INDEX ix_likes_message_id;
+            DROP INDEX ix_messages_user_timestamp;
+            ALTER TABLE messages DROP COLUMN like_count;
+            ALTER TABLE users DROP COLUMN deleted_at;
+            DROP TABLE jobs;
+            DROP INDEX ix_timeline_entries_author;
+            DELETE FROM schema_migrations WHERE version >= '0004';
+        """))
+        db.session.commit()
+
+        self.assertEqual([version for version, _ in migrations.upgrade()],
+                         ['0004', '0005', '0006', '0007', '0008', '0009'])
+
+        inspector = inspect(db.engine)
+        self.assertEqual([c['column_names'] for c in inspector.get_unique_constraints('likes')],
+                         [['user_id', 'message_id']])
+        self.assertIn('ix_messages_user_timestamp',
+                      [index['name'] for index in inspector.get_indexes('messages')])
+        self.assertIn('ix_timeline_entries_author',
+                      [index['name'] for index in inspector.get_indexes('timeline_entries')])
+        self.assertEqual(Message.query.one().like_count, 1)
@@ -0,0 +1,178 @@
+"""Query plan regression tests.
+
+Requests each hot route against a seeded database, captures the SQL it
+sends, and EXPLAINs every statement with sequential scans, sorts and hash/merge joins
+disabled. PostgreSQL then falls back to a Seq Scan, a Sort, or walking a
+whole index (no condition, or one on a later column) when no index can
+serve the query, so any of those left in a plan means a query lost (or
+never had) its index.
+"""
+
+# run these tests like:
+#
+#    python -m unittest test_query_plans.py
+
+import os
+import re
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from benchmark import pick_targets
+from models import db
+from seed import seed
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# statements worth explaining; BEGIN, SAVEPOINT etc. have no plan
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+INDEX_SCANS = ('Index Scan', 'Index Only Scan', 'Bitmap Index Scan')
+
+
+def plan_nodes(plan):
+    """Every node of an EXPLAIN (FORMAT JSON) plan, depth first."""
+
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+class QueryPlanTestCase(TestCase):
+    """Hot routes only use index scans."""
+
+    @classmethod
+    def setUpClass(cls):
+        with app.app_context():
+            seed(os.path.join(HERE, 'generator'))
+            cls.targets = pick_targets()
+
+            # index name -> its first column (None for expression indexes)
+            cls.leading = dict(db.session.execute(db.text(
+                "SELECT i.indexrelid::regclass::text, a.attname "
+                "FROM pg_index i LEFT JOIN pg_attribute a "
+                "ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]")).all())
+
+            cls.captured = None
+            db.event.listen(db.engine, 'before_cursor_execute', cls._capture)
+
+    @classmethod
+    def tearDownClass(cls):
+        with app.app_context():
+            db.event.remove(db.engine, 'before_cursor_execute', cls._capture)
+            db.drop_all()
+
+    @classmethod
+    def _capture(cls, conn, cursor, statement, parameters, context, executemany):
+        if cls.captured is not None and statement.lstrip().upper().startswith(EXPLAINABLE):
+            cls.captured.append((statement, parameters))
+
+    def setUp(self):
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.targets['viewer_id']
+
+    def statements(self, method, url):
+        """Statements sent while handling `method url`."""
+
+        QueryPlanTestCase.captured = []
+        try:
+            res = self.client.open(url.format(**self.targets), method=method)
+        finally:
+            captured, QueryPlanTestCase.captured = QueryPlanTestCase.captured, None
+        self.assertLess(res.status_code, 400, url)
+        return captured
+
+    def explain(self, statement, parameters):
+        with app.app_context(), db.engine.connect() as conn:
+            # on tables this small the planner would happily scan anything;
+            # nested loops make every join look its rows up by index
+            for setting in ('enable_seqscan', 'enable_sort',
+                            'enable_hashjoin', 'enable_mergejoin'):
+                conn.exec_driver_sql(f"SET {setting} = off")
+            [(plan,)] = conn.exec_driver_sql(
+                f"EXPLAIN (FORMAT JSON) {statement}", parameters).all()
+            conn.rollback()
+        return plan[0]['Plan']
+
+    def assertIndexed(self, method, url, allow_sort=()):
+        """Fail on a Seq Scan or full index scan anywhere, or a Sort not
+        listed in `allow_sort`.
+
+        `allow_sort` holds tables whose rows may be sorted (when only they
+        are scanned below the Sort), for orders no single index can give.
+        """
+
+        statements = self.statements(method, url)
+        self.assertTrue(statements, url)
+
+        for statement, parameters in statements:
+            self.assertPlanIndexed(url, statement, parameters, allow_sort)
+
+    def assertPlanIndexed(self, label, statement, parameters, allow_sort=()):
+        """assertIndexed() for one statement, reported under `label`."""
+
+        for node in plan_nodes(self.explain(statement, parameters)):
+            if node['Node Type'] == 'Seq Scan':
+                self.fail(f"{label}: seq scan on {node['Relation Name']} in\n{statement}")
+
+            if node['Node Type'] in INDEX_SCANS:
+                leading = self.leading.get(node['Index Name'])
+                condition = node.get('Index Cond', '')
+                if not condition or (
+                        leading and not re.search(rf'\b{leading}\b', condition)):
+                    self.fail(f"{label}: full scan of {node['Index Name']} in\n{statement}")
+
+            if node['Node Type'] in ('Sort', 'Incremental Sort'):
+                sorted_tables = {child['Relation Name']
+                                 for child in plan_nodes(node)
+                                 if 'Relation Name' in child}
+                if not sorted_tables <= set(allow_sort):
+                    self.fail(f"{label}: sort of {sorted(sorted_tables)} in\n{statement}")
+
+    def test_homepage(self):
+        # messages pulled from several high-fanout authors are merged by a
+        # sort; each author's part is still an index range
+        self.assertIndexed('GET', '/', allow_sort=['messages', 'follows', 'users'])
+
+    def test_profile(self):
+        self.assertIndexed('GET', '/users/{profile_id}')
+
+    def test_following_and_followers(self):
+        self.assertIndexed('GET', '/users/{viewer_id}/following')
+        self.assertIndexed('GET', '/users/{profile_id}/followers')
+
+    def test_liked_messages(self):
+        # ordered by the messages' timestamps, which likes can't index
+        self.assertIndexed('GET', '/users/{viewer_id}/likes',
+                           allow_sort=['messages', 'likes', 'users'])
+
+    def test_message(self):
+        self.assertIndexed('GET', '/messages/{message_id}')
+
+    def test_api(self):
+        self.assertIndexed('GET', '/api/v1/timeline',
+                           allow_sort=['messages', 'follows', 'users'])
+        self.assertIndexed('GET', '/api/v1/users/{profile_id}/messages')
+        self.assertIndexed('GET', '/api/v1/messages/{message_id}')
+
+    def test_like_and_follow_writes(self):
+        self.assertIndexed('POST', '/users/add_like/{message_id}')
+        self.assertIndexed('POST', '/users/add_like/{message_id}')
+        self.assertIndexed('POST', '/users/follow/{profile_id}')
+        self.assertIndexed('POST', '/users/stop-following/{profile_id}')
+
+    def test_delete_cascades(self):
+        # deleting a user or message leaves its rows to ON DELETE CASCADE,
+        # which EXPLAIN doesn't show; each foreign key is looked up the way
+        # the cascade does it
+        for table in db.metadata.sorted_tables:
+            for key in table.foreign_keys:
+                if (key.ondelete or '').lower() == 'cascade':
+                    self.assertPlanIndexed(
+                        f"cascade to {table.name}.{key.parent.name}",
+                        f"DELETE FROM {table.name} WHERE {key.parent.name} = %(id)s",
+                        {'id': self.targets['viewer_id']})
@@ -0,0 +1,120 @@
+"""Read replica routing tests.
+
+Uses a second local database, warbler-test-replica, as the "replica"
+(created here if the test user may create databases). It's never
+replicated into, so whatever a page shows tells us which database it read.
+"""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+
+import os
+from unittest import TestCase, SkipTest, mock
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from models import db, Message, User
+import replicas
+
+REPLICA_URL = "postgresql:///warbler-test-replica"
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def ensure_replica_database():
+    """Create the replica database if it's missing."""
+
+    try:
+        create_engine(REPLICA_URL).connect().close()
+    except OperationalError:
+        with app.app_context(), db.engine.connect() as conn:
+            try:
+                conn.execution_options(isolation_level='AUTOCOMMIT').execute(
+                    text('CREATE DATABASE "warbler-test-replica"'))
+            except ProgrammingError as exc:
+                raise SkipTest(f"can't create the replica database: {exc}")
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Which database do reads and writes go to?"""
+
+    @classmethod
+    def setUpClass(cls):
+        ensure_replica_database()
+
+    def setUp(self):
+        # no app context held across requests: each gets a fresh session,
+        # as in production
+        self.client = app.test_client()
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            user = User.signup("primary-name", "p@test.com", "password", None)
+            db.session.commit()
+            self.user_id, password = user.id, user.password
+
+        app.config['DATABASE_REPLICA_URLS'] = REPLICA_URL
+        replicas.connect(app)
+        [self.replica] = replicas.engines(app)
+
+        # the same user, as a lagging replica might still have them
+        db.metadata.drop_all(self.replica)
+        db.metadata.create_all(self.replica)
+        with self.replica.begin() as conn:
+            conn.execute(User.__table__.insert().values(
+                id=self.user_id, username="replica-name", email="p@test.com",
+                password=password))
+
+    def tearDown(self):
+        db.metadata.drop_all(self.replica)
+        app.config['DATABASE_REPLICA_URLS'] = None
+        replicas.connect(app)
+
+        with app.app_context():
+            db.drop_all()
+
+    def test_read_only_pages_read_replica(self):
+        """Are GETs of read-only pages served from the replica?"""
+        res = self.client.get(f"/users/{self.user_id}")
+        self.assertIn(b"replica-name", res.data)
+
+        # not on the list: the primary
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+        res = self.client.get("/users/profile")
+        self.assertIn(b"primary-name", res.data)
+
+    def test_replica_statements_are_instrumented(self):
+        """Are statements run on a replica engine created at runtime timed?"""
+        with mock.patch.dict(app.config, SQL_INSTRUMENTATION=True):
+            res = self.client.get(f"/users/{self.user_id}")
+        self.assertIn(b"replica-name", res.data)
+        self.assertNotIn('desc="0 statements"', res.headers["Server-Timing"])
+
+    def test_writes_go_to_primary_and_pin_reads(self):
+        """Does a write land on the primary, and does its author then
+        read their own writes?"""
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+        self.client.post("/messages/new", data={"text": "Fresh"})
+
+        with app.app_context():
+            self.assertEqual(Message.query.one().text, "Fresh")
+        with self.replica.connect() as conn:
+            self.assertEqual(conn.execute(text("SELECT count(*) FROM messages")).scalar(), 0)
+
+        res = self.client.get(f"/users/{self.user_id}")
+        self.assertIn(b"primary-name", res.data)
+        self.assertIn(b"Fresh", res.data)
+
+        # once the window has passed, back to the replica
+        with self.client.session_transaction() as sess:
+            sess[replicas.PIN_KEY] = 0
+        res = self.client.get(f"/users/{self.user_id}")
+        self.assertIn(b"replica-name", res.data)
+        self.assertNotIn(b"Fresh", res.data)
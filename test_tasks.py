@@ -0,0 +1,133 @@
+"""Background job queue tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_tasks.py
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase, mock
+
+from sqlalchemy import select
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from models import db
+import tasks
+from tasks import Job
+
+ran = []
+
+
+@tasks.job()
+def remember(value):
+    ran.append(value)
+
+
+@tasks.job()
+def explode():
+    raise RuntimeError("boom")
+
+
+@tasks.job(limit=1)
+def one_at_a_time(value):
+    ran.append(value)
+
+
+class TasksTestCase(TestCase):
+    """Queueing, claiming, running and retrying jobs."""
+
+    def setUp(self):
+        self.config = mock.patch.dict(app.config, TASKS_EAGER=False,
+                                      TASK_MAX_ATTEMPTS=2,
+                                      TASK_BACKOFF_SECONDS=60)
+        self.config.start()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.drop_all()
+        db.create_all()
+        ran.clear()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.config.stop()
+
+    def test_jobs_commit_with_their_transaction(self):
+        """Is a job queued only if its transaction commits, then run once?"""
+        tasks.enqueue(remember, "rolled back")
+        db.session.rollback()
+        tasks.enqueue(remember, "committed")
+        db.session.commit()
+        self.assertEqual(Job.query.count(), 1)
+
+        self.assertTrue(tasks.run_next())
+        self.assertFalse(tasks.run_next())
+        self.assertEqual(ran, ["committed"])
+        self.assertEqual(Job.query.count(), 0)
+
+        with self.assertRaises(ValueError):
+            tasks.enqueue(len, [])
+
+    def test_failing_job_backs_off_then_gives_up(self):
+        """Is a failed job retried later, and kept once out of attempts?"""
+        tasks.enqueue(explode)
+        db.session.commit()
+
+        self.assertTrue(tasks.run_next())
+        job = Job.query.one()
+        self.assertEqual(job.attempts, 1)
+        self.assertIsNone(job.locked_at)
+        self.assertIn("boom", job.last_error)
+        self.assertGreater(job.run_at, datetime.utcnow() + timedelta(seconds=50))
+
+        # not due yet
+        self.assertFalse(tasks.run_next())
+
+        job.run_at = datetime.utcnow()
+        db.session.commit()
+        self.assertTrue(tasks.run_next())
+        job = Job.query.one()
+        self.assertEqual(job.attempts, 2)
+        self.assertIsNotNone(job.failed_at)
+        self.assertFalse(tasks.run_next())
+
+    def test_claims_respect_limits_and_row_locks(self):
+        """Are kinds at their limit, and rows locked by others, skipped?"""
+        tasks.enqueue(one_at_a_time, 1)
+        tasks.enqueue(one_at_a_time, 2)
+        tasks.enqueue(remember, "a")
+        tasks.enqueue(remember, "b")
+        db.session.commit()
+
+        running = tasks.claim()
+        self.assertEqual((running.kind, running.args), ("one_at_a_time", [1]))
+
+        # another worker is in the middle of claiming "a"
+        with db.engine.connect() as other:
+            other.execute(select(Job).where(Job.args[0].as_string() == "a")
+                          .with_for_update())
+            claimed = tasks.claim()
+            other.rollback()
+        self.assertEqual((claimed.kind, claimed.args), ("remember", ["b"]))
+
+        # one_at_a_time #2 waits for #1
+        self.assertEqual(tasks.claim().args, ["a"])
+        self.assertIsNone(tasks.claim())
+
+    def test_worker_command(self):
+        """Does `flask worker --burst` drain the queue and exit?"""
+        for value in range(3):
+            tasks.enqueue(remember, value)
+        db.session.commit()
+        db.session.remove()
+
+        result = app.test_cli_runner().invoke(args=['worker', '--burst'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(ran, [0, 1, 2])
+
+        result = app.test_cli_runner().invoke(args=['enqueue', 'remember', '"later"'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(Job.query.one().args, ["later"])
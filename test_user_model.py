@@ -6,9 +6,9 @@
 
 
 import os
-from unittest import TestCase
-from models import db, User, Message, Follows, bcrypt
-from sqlalchemy.exc import IntegrityError
+from unittest import TestCase, mock
+from models import db, User, Message, Follows, Likes, bcrypt
+from sqlalchemy.exc import IntegrityError, NoResultFound
 from werkzeug.security import generate_password_hash
 
 
@@ -23,6 +23,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app
+import purge
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -147,4 +148,65 @@ class UserModelTestCase(TestCase):
         """Does User.authenticate fail to 
         return a user when the password is invalid?"""
         with app.app_context():
-            self.assertFalse(User.authenticate(self.u1.username, "badpassword"))
\ No newline at end of file
+            self.assertFalse(User.authenticate(self.u1.username, "badpassword"))
+
+    def test_reconcile_counts(self):
+        """Does reconcile_counts repair counters that drifted?"""
+        with app.app_context():
+            u1 = User.query.get(self.u1.id)
+            u2 = User.query.get(self.u2.id)
+            u1.following.append(u2)
+            db.session.add(Message(text="hi", user_id=u1.id))
+            db.session.commit()
+
+            self.assertEqual(User.reconcile_counts(), 2)
+            db.session.commit()
+
+            u1 = User.query.get(self.u1.id)
+            u2 = User.query.get(self.u2.id)
+            self.assertEqual((u1.messages_count, u1.following_count), (1, 1))
+            self.assertEqual(u2.followers_count, 1)
+            self.assertEqual(User.reconcile_counts(), 0)
+
+    def test_hidden_users_are_left_out(self):
+        """Are users hidden for deletion unfollowable, unlikeable and uncounted?"""
+        with app.app_context():
+            u1_id, u2_id = self.u1.id, self.u2.id
+            msg = Message(text="going", user_id=u2_id)
+            db.session.add(msg)
+            db.session.commit()
+            msg_id = msg.id
+            Follows.follow(u1_id, u2_id)
+            Likes.toggle(u1_id, msg_id)
+            db.session.commit()
+
+            # hidden, with its purge left queued
+            with mock.patch.dict(app.config, PURGE_CHUNK_SIZE=0, TASKS_EAGER=False):
+                purge.delete_user(u2_id)
+            self.assertIsNotNone(User.query.get(u2_id).deleted_at)
+
+            with self.assertRaises(NoResultFound):
+                Follows.follow(u1_id, u2_id)
+            with self.assertRaises(NoResultFound):
+                Likes.toggle(u1_id, msg_id)
+            self.assertEqual(Follows.follow_many(u1_id, [u2_id]), ([], [u2_id]))
+
+            # the follow and like are still there until the purge, uncounted
+            self.assertEqual(User.reconcile_counts(), 0)
+            self.assertEqual(Message.reconcile_like_counts(), 0)
+            self.assertTrue(Follows.unfollow(u1_id, u2_id))
+            db.session.commit()
+            u1 = User.query.get(u1_id)
+            self.assertEqual((u1.following_count, u1.likes_count), (0, 0))
+
+    def test_following_ids_among(self):
+        """Does following_ids_among return just the followed ids on the page?"""
+        with app.app_context():
+            u1 = User.query.get(self.u1.id)
+            u2 = User.query.get(self.u2.id)
+            u1.following.append(u2)
+            db.session.commit()
+
+            self.assertEqual(u1.following_ids_among([u1.id, u2.id]), {u2.id})
+            self.assertEqual(u2.following_ids_among([u1.id, u2.id]), set())
+            self.assertEqual(u1.following_ids_among([]), set())
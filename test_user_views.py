@@ -5,9 +5,11 @@
 #    FLASK_ENV=production python -m unittest test_user_views.py
 
 import os
-from unittest import TestCase
+import re
+from datetime import datetime, timedelta
+from unittest import TestCase, mock
 from flask import session
-from models import db, connect_db, Message, User, Likes
+from models import db, connect_db, Follows, Message, TimelineEntry, User, Likes
 from sqlalchemy.exc import IntegrityError
 
 # BEFORE we import our app, let's set an environmental variable
@@ -21,6 +23,8 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from fragments import message_fragment_key
+import passwords
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -32,6 +36,9 @@ from app import app, CURR_USER_KEY
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# run background jobs (see tasks.py) as soon as their transaction commits
+app.config['TASKS_EAGER'] = True
+
 class UserViewTestCase(TestCase):
     """Tests for user related routes"""
     def setUp(self):
@@ -227,4 +234,338 @@ class UserViewTestCase(TestCase):
                 self.assertIn("Sign up", html)
 
                 user = User.query.filter_by(id=self.u1.id).first()
-                self.assertIsNone(user)
\ No newline at end of file
+                self.assertIsNone(user)
+                # the database cascaded the delete to their like
+                self.assertEqual(Likes.query.count(), 0)
+
+    def test_delete_big_account_hides_then_purges(self):
+        """Is an account too big to delete at once hidden, then purged?"""
+        with app.app_context():
+            for n in range(3):
+                db.session.add(Message(text=f"Doomed {n}", user_id=self.u1.id))
+            db.session.commit()
+            User.reconcile_counts()
+            db.session.commit()
+            u1_id, u2_id = self.u1.id, self.u2.id
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = u2_id
+                c.post(f"/users/follow/{u1_id}")
+                self.assertIn("Doomed 2", c.get("/").get_data(as_text=True))
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = u1_id
+                deferred = []
+                with mock.patch.dict(app.config, PURGE_CHUNK_SIZE=2), \
+                        mock.patch('tasks.enqueue', lambda *task: deferred.append(task)):
+                    c.post("/users/delete")
+
+                    # hidden straight away, everywhere
+                    self.assertEqual(c.get(f"/users/{u1_id}").status_code, 404)
+                    self.assertNotIn("testpotato", c.get("/users").get_data(as_text=True))
+                    res = c.post("/login", data={"username": "testpotato",
+                                                 "password": "testuser"})
+                    self.assertIn("Invalid credentials", res.get_data(as_text=True))
+                    with c.session_transaction() as sess:
+                        sess[CURR_USER_KEY] = u2_id
+                    self.assertNotIn("Doomed", c.get("/").get_data(as_text=True))
+                    self.assertEqual(User.query.get(u2_id).followers_count, 0)
+                    self.assertEqual(c.post(f"/users/follow/{u1_id}").status_code, 404)
+                    c.post(f"/users/stop-following/{u1_id}")
+                    self.assertEqual(User.query.get(u2_id).following_count, 0)
+
+                    [(task, user_id)] = deferred
+                    task(user_id)
+
+            db.session.expire_all()
+            self.assertIsNone(User.query.get(u1_id))
+            self.assertEqual(Message.query.filter_by(user_id=u1_id).count(), 0)
+            self.assertEqual(Follows.query.count(), 0)
+
+    def test_delete_counts_timeline_entries_and_likes_received(self):
+        """Do rows the counters miss make an account too big to delete at once?"""
+        with app.app_context():
+            u1_id, u2_id = self.u1.id, self.u2.id
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = u1_id
+                c.post(f"/users/follow/{u2_id}")
+
+                # one follower, one copy of their message, one like on it
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = u2_id
+                deferred = []
+                with mock.patch.dict(app.config, PURGE_CHUNK_SIZE=2), \
+                        mock.patch('tasks.enqueue', lambda *task: deferred.append(task)):
+                    c.post("/users/delete")
+                    self.assertIsNotNone(User.query.get(u2_id).deleted_at)
+
+                    [(task, user_id)] = deferred
+                    task(user_id)
+
+            db.session.expire_all()
+            self.assertIsNone(User.query.get(u2_id))
+            self.assertEqual(TimelineEntry.query.count(), 0)
+            self.assertEqual(Likes.query.count(), 0)
+
+    def test_follow_backfills_and_unfollow_clears_timeline(self):
+        """Does following pull in a user's messages, and unfollowing drop them?"""
+        with app.app_context():
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1.id
+
+                c.post(f"/users/follow/{self.u2.id}")
+                res = c.get("/")
+                self.assertIn("A liked message", res.get_data(as_text=True))
+
+                c.post(f"/users/stop-following/{self.u2.id}")
+                res = c.get("/")
+                self.assertNotIn("A liked message", res.get_data(as_text=True))
+
+    def test_show_users_paginates_with_cursor(self):
+        """Does ?before= page back through a profile's messages?"""
+        with app.app_context():
+            now = datetime.utcnow()
+            for i, text in enumerate(["newest", "middle"]):
+                db.session.add(Message(text=text, user_id=self.u2.id,
+                                       timestamp=now + timedelta(minutes=2 - i)))
+            db.session.commit()
+
+            with mock.patch('app.MESSAGES_PER_PAGE', 2):
+                res = self.client.get(f"/users/{self.u2.id}")
+                html = res.get_data(as_text=True)
+                self.assertIn("newest", html)
+                self.assertIn("middle", html)
+                self.assertNotIn("A liked message", html)
+
+                older = re.search(r'href="([^"]+\?before=[^"]+)"', html).group(1)
+                html = self.client.get(older).get_data(as_text=True)
+                self.assertIn("A liked message", html)
+                self.assertNotIn("newest", html)
+                self.assertNotIn("Older messages", html)
+
+    def test_show_users_rejects_bad_cursor(self):
+        """Is a malformed cursor a 400 rather than a crash?"""
+        res = self.client.get(f"/users/{self.u2.id}?before=not-a-cursor")
+        self.assertEqual(res.status_code, 400)
+
+    def test_follow_routes_keep_counters(self):
+        """Do follow/unfollow keep the denormalized counters current?"""
+        with app.app_context():
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1.id
+
+                c.post(f"/users/follow/{self.u2.id}")
+                self.assertEqual(User.query.get(self.u1.id).following_count, 1)
+                self.assertEqual(User.query.get(self.u2.id).followers_count, 1)
+
+                c.post(f"/users/stop-following/{self.u2.id}")
+                self.assertEqual(User.query.get(self.u1.id).following_count, 0)
+                self.assertEqual(User.query.get(self.u2.id).followers_count, 0)
+
+    def test_follow_routes_are_idempotent(self):
+        """Do repeated follows/unfollows count once, and bad ids not crash?"""
+        with app.app_context():
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1.id
+
+                c.post(f"/users/follow/{self.u2.id}")
+                c.post(f"/users/follow/{self.u2.id}")
+                self.assertEqual(Follows.query.count(), 1)
+                self.assertEqual(User.query.get(self.u2.id).followers_count, 1)
+
+                c.post(f"/users/stop-following/{self.u2.id}")
+                res = c.post(f"/users/stop-following/{self.u2.id}")
+                self.assertEqual(res.status_code, 302)
+                self.assertEqual(User.query.get(self.u1.id).following_count, 0)
+                self.assertEqual(User.query.get(self.u2.id).followers_count, 0)
+
+                self.assertEqual(c.post("/users/follow/999999").status_code, 404)
+                self.assertEqual(c.post("/users/stop-following/999999").status_code, 302)
+
+    def test_list_users_shows_follow_state(self):
+        """Does the directory mark followed users with an Unfollow button?"""
+        with app.app_context():
+            u1 = User.query.get(self.u1.id)
+            u1.following.append(User.query.get(self.u2.id))
+            db.session.commit()
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1.id
+                html = c.get("/users").get_data(as_text=True)
+
+            self.assertIn(f'action="/users/stop-following/{self.u2.id}"', html)
+            self.assertIn(f'action="/users/follow/{self.u1.id}"', html)
+
+    def test_search_users_ranks_username_matches_first(self):
+        """Does search match prefixes across fields, username hits first?"""
+        with app.app_context():
+            u2 = User.query.get(self.u2.id)
+            u2.bio = "Biggest testpotato fan"
+            db.session.commit()
+
+            html = self.client.get("/users?q=testpot").get_data(as_text=True)
+
+            self.assertIn("@testpotato", html)
+            self.assertIn("@testuser2", html)
+            self.assertLess(html.index("@testpotato"), html.index("@testuser2"))
+
+            html = self.client.get("/users?q=nomatch").get_data(as_text=True)
+            self.assertIn("Sorry, no users found", html)
+
+    def test_autocomplete_users(self):
+        """Does autocomplete return username-prefix matches as JSON?"""
+        res = self.client.get("/users/autocomplete?q=testp")
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([u["username"] for u in res.json], ["testpotato"])
+
+    def test_current_user_snapshot_is_cached_until_edit(self):
+        """Is g.user served from cache and refreshed after a profile edit?"""
+        with app.app_context():
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1.id
+                c.get("/")
+
+                # a write that bypasses the routes isn't seen until invalidated
+                User.query.get(self.u1.id).image_url = "/static/images/sneaky.png"
+                db.session.commit()
+                self.assertNotIn("sneaky.png", c.get("/").get_data(as_text=True))
+
+                c.post('/users/profile',
+                       data={"username": "testpotato",
+                             "email": "test@test.com",
+                             "image_url": "/static/images/edited.png",
+                             "password": "testuser"})
+                self.assertIn("edited.png", c.get("/").get_data(as_text=True))
+
+    def test_login_rehashes_at_new_cost(self):
+        """Is a stored hash upgraded when the bcrypt cost setting changes?"""
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        try:
+            with app.app_context():
+                self.client.post('/login', data=dict(username="testpotato",
+                                                     password="testuser"))
+
+                user = User.query.get(self.u1.id)
+                self.assertTrue(user.password.startswith("$2b$04$"))
+                self.assertTrue(User.authenticate("testpotato", "testuser"))
+        finally:
+            app.config['BCRYPT_LOG_ROUNDS'] = 12
+
+    def test_login_rejected_fast_when_password_pool_is_full(self):
+        """Does a saturated password pool answer 503 instead of queueing?"""
+        passwords.reset_pool()
+        try:
+            with mock.patch.dict(app.config, PASSWORD_QUEUE_DEPTH=0):
+                res = self.client.post('/login', data=dict(username="testpotato",
+                                                           password="testuser"))
+
+            self.assertEqual(res.status_code, 503)
+            self.assertEqual(res.headers["Retry-After"], "1")
+        finally:
+            passwords.reset_pool()
+
+    def test_login_rejected_when_password_check_times_out(self):
+        """Is a password check that outlasts PASSWORD_TIMEOUT a 503 too?"""
+        with mock.patch.dict(app.config, PASSWORD_TIMEOUT=0.001):
+            res = self.client.post('/login', data=dict(username="testpotato",
+                                                       password="testuser"))
+
+        self.assertEqual(res.status_code, 503)
+
+    def test_show_users_answers_304_until_profile_changes(self):
+        """Is an unchanged profile revalidated with a 304 instead of re-sent?"""
+        res = self.client.get(f"/users/{self.u2.id}")
+        etag = res.headers["ETag"]
+        self.assertEqual(res.headers["Cache-Control"], "public, no-cache")
+        self.assertIn("Last-Modified", res.headers)
+
+        res = self.client.get(f"/users/{self.u2.id}",
+                              headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b"")
+
+        # pending flash messages are never served from a validator
+        with self.client.session_transaction() as sess:
+            sess["_flashes"] = [("success", "Hello!")]
+        res = self.client.get(f"/users/{self.u2.id}",
+                              headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers["Cache-Control"], "no-store")
+
+        # posting bumps messages_count, and with it the row version
+        author = app.test_client()
+        with author.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u2.id
+        author.post("/messages/new", data={"text": "Fresh news"})
+
+        res = self.client.get(f"/users/{self.u2.id}",
+                              headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("Fresh news", res.get_data(as_text=True))
+
+    def test_homepage_revalidates_per_viewer(self):
+        """Is the timeline a 304 until it or the viewer's likes change?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+
+            c.post("/messages/new", data={"text": "First post"})
+            res = c.get("/")
+            etag = res.headers["ETag"]
+            self.assertEqual(res.headers["Cache-Control"], "private, no-cache")
+            self.assertNotIn("Last-Modified", res.headers)
+
+            res = c.get("/", headers={"If-None-Match": etag})
+            self.assertEqual(res.status_code, 304)
+
+            c.post("/messages/new", data={"text": "Second post"})
+            res = c.get("/", headers={"If-None-Match": etag})
+            self.assertEqual(res.status_code, 200)
+            self.assertIn("Second post", res.get_data(as_text=True))
+
+        # someone else's copy of the same timeline never matches
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2.id
+            res = c.get("/", headers={"If-None-Match": etag})
+            self.assertEqual(res.status_code, 200)
+
+    def test_message_fragments_are_cached_until_author_changes(self):
+        """Are message list items reused, and re-rendered after a profile edit?"""
+        fragments = app.extensions['fragment_cache']
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+
+            c.post("/messages/new", data={"text": "Cached post"})
+            self.assertIn("@testpotato", c.get("/").get_data(as_text=True))
+
+            # the cached fragment, not the row, is what gets rendered
+            Message.query.filter_by(text="Cached post").one().text = "Sneaky edit"
+            db.session.commit()
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("Cached post", html)
+            self.assertNotIn("Sneaky edit", html)
+
+            c.post('/users/profile',
+                   data={"username": "renamedpotato",
+                         "email": "test@test.com",
+                         "password": "testuser"})
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("@renamedpotato", html)
+            self.assertNotIn("@testpotato", html)
+
+            # the like button stays outside the fragment
+            msg = Message.query.filter_by(user_id=self.u1.id).one()
+            key = message_fragment_key('home', msg, msg.user)
+            self.assertNotIn("add_like", fragments.get(key))
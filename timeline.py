@@ -0,0 +1,319 @@
+"""Materialized home timelines for Warbler.
+
+Messages are written into a `timeline_entries` row per reader when they are
+posted (fan-out on write), so the homepage reads a pre-sorted slice instead
+of gathering every followed user's messages on each hit.
+
+Accounts with a very large number of followers are not fanned out: their
+followers pull those messages at read time and merge them into the slice.
+An account that drops back below the limit has its recent messages copied
+out to its followers (catch_up_author()), as pulling them stops.
+"""
+
+from flask import current_app
+from sqlalchemy import delete, func, insert, literal, select, true
+from sqlalchemy.orm import joinedload
+
+import tasks
+from models import db, Follows, Message, TimelineEntry, User
+from pagination import before as older_than
+
+# Accounts with at least this many followers are read at request time
+# instead of being copied into every follower's timeline.
+FANOUT_FOLLOWER_LIMIT = 10000
+
+# How many of a user's recent messages are copied in when someone follows them.
+BACKFILL_LIMIT = 1000
+
+
+def fanout_limit():
+    """Follower count at which an author stops being fanned out."""
+
+    return current_app.config.get('TIMELINE_FANOUT_LIMIT', FANOUT_FOLLOWER_LIMIT)
+
+
+def is_high_fanout(user_id):
+    """Does `user_id` have too many followers to fan out on write?
+
+    Reads the followers_count counter, as _pulled_authors() does, so
+    writers and readers agree on who is pulled.
+    """
+
+    count = db.session.execute(
+        select(User.followers_count).where(User.id == user_id)).scalar()
+    return count is not None and count >= fanout_limit()
+
+
+def fan_out_message(msg):
+    """Write a freshly flushed message into the relevant timelines.
+
+    The author gets it straight away; followers get it from a background
+    job (unless the author is a high-fanout account).
+    """
+
+    db.session.execute(insert(TimelineEntry).values(
+        user_id=msg.user_id,
+        message_id=msg.id,
+        author_id=msg.user_id,
+        timestamp=msg.timestamp,
+    ))
+    tasks.enqueue(deliver_message, msg.id)
+
+
+@tasks.job()
+def deliver_message(message_id):
+    """Write message `message_id` into its author's followers' timelines."""
+
+    msg = db.session.get(Message, message_id)
+    if msg is None or is_high_fanout(msg.user_id):
+        return
+
+    # followers who followed since, and got it by backfill, already have it
+    delivered = (select(TimelineEntry.user_id)
+                 .where(TimelineEntry.message_id == msg.id)
+                 .where(TimelineEntry.user_id == Follows.user_following_id))
+    followers = (select(Follows.user_following_id,
+                        literal(msg.id, db.Integer),
+                        literal(msg.user_id, db.Integer),
+                        literal(msg.timestamp, db.DateTime))
+                 .where(Follows.user_being_followed_id == msg.user_id)
+                 .where(Follows.user_following_id != msg.user_id)
+                 .where(~delivered.exists()))
+    db.session.execute(insert(TimelineEntry).from_select(
+        ['user_id', 'message_id', 'author_id', 'timestamp'], followers))
+
+
+def backfill_follow(follower_id, followed_id):
+    """Copy `followed_id`'s recent messages into `follower_id`'s timeline."""
+
+    if follower_id == followed_id or is_high_fanout(followed_id):
+        return
+
+    # deliver_message may have got there first
+    delivered = (select(TimelineEntry.message_id)
+                 .where(TimelineEntry.user_id == follower_id)
+                 .where(TimelineEntry.message_id == Message.id))
+    recent = (select(literal(follower_id, db.Integer),
+                     Message.id,
+                     Message.user_id,
+                     Message.timestamp)
+              .where(Message.user_id == followed_id)
+              .where(~delivered.exists())
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .limit(BACKFILL_LIMIT))
+    db.session.execute(insert(TimelineEntry).from_select(
+        ['user_id', 'message_id', 'author_id', 'timestamp'], recent))
+
+
+def drop_follow(follower_id, followed_id):
+    """Remove `followed_id`'s messages from `follower_id`'s timeline.
+
+    Call after the unfollow has been counted.
+    """
+
+    if follower_id == followed_id:
+        return
+
+    db.session.execute(
+        delete(TimelineEntry)
+        .where(TimelineEntry.user_id == follower_id)
+        .where(TimelineEntry.author_id == followed_id))
+    catch_up_authors([followed_id])
+
+
+def catch_up_authors(user_ids):
+    """Queue catch_up_author() for each of `user_ids` (a list or a select
+    of ids) that has just lost the follower taking it below the fan-out
+    limit.
+
+    Call after decrementing their followers_count by one.
+    """
+
+    dropped = db.session.scalars(
+        select(User.id)
+        .where(User.id.in_(user_ids))
+        .where(User.followers_count == fanout_limit() - 1)
+        .where(User.deleted_at.is_(None))).all()
+    for user_id in dropped:
+        tasks.enqueue(catch_up_author, user_id)
+
+
+@tasks.job(limit=2)
+def catch_up_author(author_id):
+    """Copy `author_id`'s recent messages into all their followers' timelines.
+
+    Messages posted while the author was pulled at read time were never
+    fanned out; once they're fanned out again nobody pulls them.
+    """
+
+    if is_high_fanout(author_id):
+        return
+
+    recent = (select(Message.id, Message.timestamp)
+              .where(Message.user_id == author_id)
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .limit(BACKFILL_LIMIT)
+              .subquery())
+    delivered = (select(TimelineEntry.user_id)
+                 .where(TimelineEntry.user_id == Follows.user_following_id)
+                 .where(TimelineEntry.message_id == recent.c.id))
+    missing = (select(Follows.user_following_id,
+                      recent.c.id,
+                      literal(author_id, db.Integer),
+                      recent.c.timestamp)
+               .join(recent, true())
+               .where(Follows.user_being_followed_id == author_id)
+               .where(Follows.user_following_id != author_id)
+               .where(~delivered.exists()))
+    db.session.execute(insert(TimelineEntry).from_select(
+        ['user_id', 'message_id', 'author_id', 'timestamp'], missing))
+
+
+@tasks.job(limit=4)
+def backfill_follows(follower_id, followed_ids):
+    """backfill_follow() each of `followed_ids` `follower_id` still follows.
+
+    A background job; any unfollowed since it was queued are skipped.
+    """
+
+    still_followed = db.session.scalars(
+        select(Follows.user_being_followed_id)
+        .where(Follows.user_following_id == follower_id)
+        .where(Follows.user_being_followed_id.in_(followed_ids))).all()
+    for followed_id in still_followed:
+        backfill_follow(follower_id, followed_id)
+
+
+def drop_follows(follower_id, followed_ids):
+    """drop_follow() for many `followed_ids` in one DELETE."""
+
+    db.session.execute(
+        delete(TimelineEntry)
+        .where(TimelineEntry.user_id == follower_id)
+        .where(TimelineEntry.author_id.in_(followed_ids))
+        .where(TimelineEntry.author_id != follower_id))
+    catch_up_authors(followed_ids)
+
+
+def _pulled_authors(user_id):
+    """Subquery of high-fanout accounts that `user_id` follows, leaving
+    out any hidden for deletion."""
+
+    # a subquery rather than a join, so each account is looked up by id;
+    # it's NULL, and the account left out, for hidden accounts
+    followers_count = (select(User.followers_count)
+                       .where(User.id == Follows.user_being_followed_id)
+                       .where(User.deleted_at.is_(None))
+                       .scalar_subquery())
+    return (select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == user_id)
+            .where(Follows.user_being_followed_id != user_id)
+            .where(followers_count >= fanout_limit()))
+
+
+def home_timeline_keys(user_id, limit=100, before=None):
+    """`(timestamp, message_id)` of the newest `limit` messages for
+    `user_id`'s homepage.
+
+    Reads the materialized slice and merges in messages from followed
+    high-fanout accounts, newest first. `before` is a decoded
+    `(timestamp, id)` cursor; only older messages are returned. Messages
+    by authors hidden for deletion (see purge.py) are left out here, so
+    pages stay full.
+    """
+
+    entries = (select(TimelineEntry.timestamp, TimelineEntry.message_id)
+               .join(User, User.id == TimelineEntry.author_id)
+               .where(TimelineEntry.user_id == user_id)
+               .where(User.deleted_at.is_(None)))
+    pulled = (select(Message.timestamp, Message.id)
+              .where(Message.user_id.in_(_pulled_authors(user_id))))
+
+    if before is not None:
+        entries = entries.where(older_than(TimelineEntry.timestamp,
+                                           TimelineEntry.message_id, before))
+        pulled = pulled.where(older_than(Message.timestamp, Message.id, before))
+
+    keys = db.session.execute(
+        entries
+        .order_by(TimelineEntry.timestamp.desc(),
+                  TimelineEntry.message_id.desc())
+        .limit(limit)).all()
+
+    keys += db.session.execute(
+        pulled
+        .order_by(Message.timestamp.desc(), Message.id.desc())
+        .limit(limit)).all()
+
+    return sorted(set(keys), reverse=True)[:limit]
+
+
+def load_messages(ids):
+    """Messages `ids`, in that order, with their authors loaded.
+
+    Messages by authors hidden for deletion (see purge.py) since `ids` were
+    read are left out.
+    """
+
+    if not ids:
+        return []
+
+    # authors are joined in: the template reads msg.user for every row
+    messages = {msg.id: msg for msg in (Message.query
+                                        .options(joinedload(Message.user))
+                                        .filter(Message.id.in_(ids)))
+                if msg.user.deleted_at is None}
+    return [messages[message_id] for message_id in ids if message_id in messages]
+
+
+def list_version(message_ids):
+    """What a list of `message_ids` shows that can change in place.
+
+    That's each message's like count and its author's profile (as the
+    latest `updated_at` among them); use it alongside the ids in an ETag.
+    """
+
+    if not message_ids:
+        return None
+
+    rows = db.session.execute(
+        select(Message.id, Message.like_count, User.updated_at)
+        .join(User, User.id == Message.user_id)
+        .where(Message.id.in_(message_ids))
+        .order_by(Message.id)).all()
+    return [max(filter(None, (row.updated_at for row in rows)), default=None),
+            [(row.id, row.like_count) for row in rows]]
+
+
+def home_timeline(user_id, limit=100, before=None):
+    """The newest `limit` messages for `user_id`'s homepage, authors loaded."""
+
+    keys = home_timeline_keys(user_id, limit, before)
+    return load_messages([message_id for _, message_id in keys])
+
+
+def rebuild_timelines():
+    """Recompute every materialized timeline from messages and follows.
+
+    Used after bulk loads (e.g. seeding) that bypass the routes.
+    """
+
+    db.session.execute(delete(TimelineEntry))
+
+    own = select(Message.user_id, Message.id, Message.user_id, Message.timestamp)
+    db.session.execute(insert(TimelineEntry).from_select(
+        ['user_id', 'message_id', 'author_id', 'timestamp'], own))
+
+    # counted once per author, not once per (follower, message) row
+    fanned_out = (select(Follows.user_being_followed_id)
+                  .group_by(Follows.user_being_followed_id)
+                  .having(func.count() < fanout_limit()))
+    followed = (select(Follows.user_following_id,
+                       Message.id,
+                       Message.user_id,
+                       Message.timestamp)
+                .join(Message, Message.user_id == Follows.user_being_followed_id)
+                .where(Follows.user_following_id != Follows.user_being_followed_id)
+                .where(Message.user_id.in_(fanned_out)))
+    db.session.execute(insert(TimelineEntry).from_select(
+        ['user_id', 'message_id', 'author_id', 'timestamp'], followed))